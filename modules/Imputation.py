@@ -1,50 +1,169 @@
-def lowImputer(a, percentile):
+def lowImputer(a, percentile, seed=None):
     """
     Imputes missing values (NaN) by sampling from the
     lowest percentile of values from the series
+
+    Keyword arguments:
+    a -- series or array of values
+    percentile -- percentile (0-100) below which the values are sampled
+    seed -- seed of the random number generator for reproducible results
     """
-    
+
     import numpy as np
-    
-    a = np.array(a)
-    
-    if sum(np.isnan(a)) == len(a):
+
+    a = np.array(a, dtype=np.float64)
+
+    if np.isnan(a).all():
         return a
-    
-    # calculate std and mean of original distribution
-    std_full = np.nanstd(a)
-    mean_full = np.nanmean(a)
-    # calculate the percentile for 1% of the data
-    perc = np.nanpercentile(a, percentile)
-
-    print('a: %s' % a)
-    
-    b = a[~np.isnan(a)]
-    
-    subset = b[b < perc]
-    # integer is required to reduce computational effort for distribution calc
-    subset = subset.astype(int)
-    
-    print('subset: %s' % subset)
-    
-    # do some basic statistics to compute the distribution
-    std_subset = subset.std()
-    mean_subset = subset.mean()
-
-    print('std_subs: %s' % std_subset)
-    print('mean_subs: %s' % mean_subset)
-    
-    #Find indicies that you need to replace
-    inds = np.where(np.isnan(a))
-
-    # replace NaN by small numbers sampled from the quantile
-    # a.fillna(2**np.random.normal(loc=mean_subset, scale=std_subset),
-    #                             inplace=True)
-            
-    if std_subset == 0:
-        a[inds] = mean_subset
+
+    imputed, parameters = PercentileImputer(a[:, None], percentile, seed=seed)
+
+    return imputed[:, 0]
+
+
+def ImputationParameters(matrix, percentile=1):
+    """
+    Calculate the distribution of all and of the lowest values per column
+
+    Keyword arguments:
+    matrix -- 2D array (e.g. proteins x experiments) with NaN for missing
+    values
+    percentile -- percentile (0-100) below which values count as lowest
+
+    Returns:
+    parameters -- dict of arrays with one value per column: mean_full,
+    std_full, quantile (value of the percentile), mean_subset, std_subset
+    (of the values below the quantile) and missing (number of NaN)
+    """
+    import warnings
+    import numpy as np
+
+    matrix = np.asarray(matrix, dtype=np.float64)
+    observed = ~np.isnan(matrix)
+
+    with warnings.catch_warnings():
+        # columns without values give NaN parameters
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        quantile = np.nanpercentile(matrix, percentile, axis=0)
+        subset = np.where(matrix < quantile, matrix, np.nan)
+        # if no value is below the quantile take the values equal to it
+        empty = np.isnan(subset).all(axis=0)
+        subset[:, empty] = np.where(matrix[:, empty] <= quantile[empty],
+                                    matrix[:, empty], np.nan)
+
+        parameters = {'mean_full': np.nanmean(matrix, axis=0),
+                      'std_full': np.nanstd(matrix, axis=0, ddof=1),
+                      'quantile': quantile,
+                      'mean_subset': np.nanmean(subset, axis=0),
+                      'std_subset': np.nanstd(subset, axis=0, ddof=1),
+                      'missing': (~observed).sum(axis=0)}
+
+    return parameters
+
+
+def ImputeNormal(matrix, means, stds, seed=None, threads=1):
+    """
+    Replace every missing value by its own draw from a normal distribution
+    with the mean and standard deviation of its column
+
+    Every column gets an independent random number generator spawned from
+    the seed, so the result does not depend on the number of threads.
+
+    Keyword arguments:
+    matrix -- 2D array with NaN for missing values, it is not modified
+    means -- mean of the distribution per column
+    stds -- standard deviation of the distribution per column, NaN is
+    treated as 0
+    seed -- seed (or numpy SeedSequence) for reproducible results
+    threads -- number of threads imputing blocks of columns in parallel
+
+    Returns:
+    imputed -- copy of matrix with imputed values
+    """
+    import numpy as np
+
+    imputed = np.array(matrix, dtype=np.float64)
+    means = np.broadcast_to(np.asarray(means, dtype=np.float64),
+                            imputed.shape[1:])
+    stds = np.nan_to_num(np.broadcast_to(np.asarray(stds, dtype=np.float64),
+                                         imputed.shape[1:]))
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    generators = [np.random.default_rng(s)
+                  for s in seed.spawn(imputed.shape[1])]
+
+    def impute(columns):
+        for col in columns:
+            missing = np.flatnonzero(np.isnan(imputed[:, col]))
+            if missing.size:
+                imputed[missing, col] = generators[col].normal(
+                    loc=means[col], scale=stds[col], size=missing.size)
+
+    blocks = np.array_split(np.arange(imputed.shape[1]),
+                            max(1, min(threads, imputed.shape[1])))
+    if len(blocks) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+            list(pool.map(impute, blocks))
     else:
-        #Place column means in the indices. Align the arrays using take
-        a[inds] = np.random.normal(loc=mean_subset, scale=std_subset)
-    
-    return a
\ No newline at end of file
+        for block in blocks:
+            impute(block)
+
+    return imputed
+
+
+def PercentileImputer(matrix, percentile=1, reference=None, seed=None,
+                      threads=1):
+    """
+    Impute missing values per column by sampling from the distribution of
+    the values below a low percentile
+
+    Keyword arguments:
+    matrix -- 2D array (e.g. log2 intensities of proteins x experiments)
+    with NaN for missing values
+    percentile -- percentile (0-100) below which the values are sampled
+    reference -- matrix to take the distributions from (e.g. all proteins
+    when imputing a subset), default matrix
+    seed -- seed of the random number generator for reproducible results
+    threads -- number of threads imputing blocks of columns in parallel
+
+    Returns:
+    imputed -- copy of matrix with imputed values
+    parameters -- distribution per column, see ImputationParameters
+    """
+    parameters = ImputationParameters(matrix if reference is None
+                                      else reference, percentile)
+    imputed = ImputeNormal(matrix, parameters['mean_subset'],
+                           parameters['std_subset'], seed, threads)
+
+    return imputed, parameters
+
+
+def DownshiftImputer(matrix, width=0.3, shift=1.8, seed=None, threads=1):
+    """
+    Impute missing values per column from a normal distribution shifted
+    down from the distribution of the measured values (as in Perseus)
+
+    Keyword arguments:
+    matrix -- 2D array (e.g. log2 intensities of proteins x experiments)
+    with NaN for missing values
+    width -- standard deviation of the imputed values relative to the
+    standard deviation of the column
+    shift -- downshift of the mean in standard deviations of the column
+    seed -- seed of the random number generator for reproducible results
+    threads -- number of threads imputing blocks of columns in parallel
+
+    Returns:
+    imputed -- copy of matrix with imputed values
+    """
+    import warnings
+    import numpy as np
+
+    matrix = np.asarray(matrix, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        means = np.nanmean(matrix, axis=0)
+        stds = np.nanstd(matrix, axis=0, ddof=1)
+
+    return ImputeNormal(matrix, means - shift * stds, width * stds, seed,
+                        threads)
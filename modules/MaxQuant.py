@@ -7,13 +7,273 @@ Created on Thu Feb  2 17:44:08 2017
 
 import pandas as pd
 import os
+import re
 import sys
 import numpy as np
 
-import matplotlib.pyplot as plt
+try:
+    from . import Imputation
+except ImportError:
+    import Imputation
+
+# columns holding intensities, read as float64 whatever the values look like
+# (e.g. integer iBAQs or columns without any value)
+_FLOAT_PREFIXES = ('iBAQ', 'Intensity', 'LFQ intensity', 'Reporter intensity',
+                   'Top3')
+
+# repetitive text columns, stored as categories
+_CATEGORICAL_COLUMNS = ('Protein IDs', 'Majority protein IDs', 'Proteins',
+                        'Leading proteins', 'Leading razor protein',
+                        'Gene names', 'Protein names', 'Reverse',
+                        'Potential contaminant', 'Only identified by site',
+                        'Raw file', 'Experiment', 'Type', 'Modifications')
+
+def MaxQuantDtypes(columns):
+    """
+    Return the dtypes to read MaxQuant columns with
+
+    Keyword arguments:
+    columns -- names of the columns to read
+
+    Returns:
+    dtypes -- dict mapping the intensity and categorical columns to their dtype
+    """
+    dtypes = {}
+    for column in columns:
+        if column in _CATEGORICAL_COLUMNS:
+            dtypes[column] = 'category'
+        elif column.startswith(_FLOAT_PREFIXES):
+            dtypes[column] = np.float64
+    return dtypes
+
+def MaxQuantColumns(titles=None, prefixes=('iBAQ',),
+                    columns=('Protein IDs', 'Reverse', 'Potential contaminant')):
+    """
+    Return a column selection for ReadMaxQuantTable
+
+    Keyword arguments:
+    titles -- list of experiment names as given to MQ, None for no
+    experiment columns
+    prefixes -- prefixes of the experiment columns to read, e.g. 'iBAQ' for
+    'iBAQ <title>'
+    columns -- further columns to read
+
+    Returns:
+    usecols -- callable returning True for the names of the selected columns,
+    names missing in the table are ignored
+    """
+    selected = set(columns)
+    if titles is not None:
+        selected.update('{} {}'.format(prefix, title)
+                        for prefix in prefixes for title in titles)
+    return lambda name: name in selected
+
+def _ParquetPath(file):
+    """
+    Return the path of the parquet copy of a MaxQuant txt file if it exists
+    and is newer than the txt file, else None
+    """
+    if file.endswith('.parquet'):
+        return file
+    parquet = os.path.splitext(file)[0] + '.parquet'
+    if os.path.isfile(parquet) and\
+       os.path.getmtime(parquet) >= os.path.getmtime(file):
+        return parquet
+    return None
+
+def _SelectColumns(names, usecols):
+    """
+    Return the names selected by a list or callable, all if usecols is None
+    """
+    if usecols is None:
+        return list(names)
+    if callable(usecols):
+        return [name for name in names if usecols(name)]
+    return [name for name in names if name in set(usecols)]
+
+def _IterParquet(file, columns, chunksize):
+    """
+    Yield a parquet file as dataframes of at most chunksize rows
+    """
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(file).iter_batches(batch_size=chunksize,
+                                                   columns=columns):
+        yield batch.to_pandas()
+
+def ReadMaxQuantTable(file, usecols=None, chunksize=None, use_parquet=True):
+    """
+    Read a MaxQuant output table (proteinGroups.txt, evidence.txt, ...)
+
+    Only the selected columns are parsed. Intensity columns are read as
+    float64 and protein IDs, flags and file names as categories, which takes
+    a fraction of the memory of the inferred dtypes. If a parquet copy
+    written by ConvertToParquet is found next to the file it is read instead.
+
+    Keyword arguments:
+    file -- path to the tab separated MaxQuant table (or its parquet copy)
+    usecols -- list of column names or callable selecting column names (see
+    MaxQuantColumns), None for all columns
+    chunksize -- return an iterator over dataframes of chunksize rows instead
+    of a single dataframe
+    use_parquet -- read the parquet copy if there is an up-to-date one
+
+    Returns:
+    data -- pandas dataframe or iterator over dataframes if chunksize is set
+    """
+    parquet = _ParquetPath(file) if use_parquet else None
+
+    if parquet is not None:
+        import pyarrow.parquet as pq
+
+        columns = _SelectColumns(pq.read_schema(parquet).names, usecols)
+        if chunksize is None:
+            return pd.read_parquet(parquet, columns=columns)
+        return _IterParquet(parquet, columns, chunksize)
+
+    header = pd.read_csv(file, sep='\t', nrows=0).columns
+    columns = _SelectColumns(header, usecols)
+
+    return pd.read_csv(file, sep='\t', usecols=columns,
+                       dtype=MaxQuantDtypes(columns),
+                       chunksize=chunksize)
+
+def ConvertToParquet(txt_path, tables=None, chunksize=10**6):
+    """
+    Convert the tables of a MaxQuant txt folder to parquet files next to them
+    which are read by ReadMaxQuantTable from then on
+
+    The tables are converted in chunks so that files larger than memory can
+    be converted. Integer columns are stored as float64 so that chunks with
+    missing values fit the same schema. Requires pyarrow.
+
+    Keyword arguments:
+    txt_path -- path to the MaxQuant txt folder
+    tables -- names of the tables to convert (e.g. ['proteinGroups',
+    'evidence']), None for all txt files in the folder
+    chunksize -- number of rows converted at once
+
+    Returns:
+    converted -- list of paths of the written parquet files
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if tables is None:
+        tables = sorted(os.path.splitext(f)[0] for f in os.listdir(txt_path)
+                        if f.endswith('.txt'))
+
+    converted = []
+    for table_name in tables:
+        file = os.path.join(txt_path, table_name + '.txt')
+        parquet = os.path.join(txt_path, table_name + '.parquet')
+        print('Converting {}...'.format(file))
+
+        writer = None
+        try:
+            for chunk in ReadMaxQuantTable(file, chunksize=chunksize,
+                                           use_parquet=False):
+                if writer is None:
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    # fix the types that depend on the values of the chunk
+                    fields = []
+                    for field in schema:
+                        if pa.types.is_null(field.type):
+                            field = field.with_type(pa.string())
+                        elif pa.types.is_integer(field.type):
+                            field = field.with_type(pa.float64())
+                        fields.append(field)
+                    schema = pa.schema(fields, metadata=schema.metadata)
+                    writer = pq.ParquetWriter(parquet + '.tmp', schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema,
+                                                        preserve_index=False))
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is not None:
+            os.replace(parquet + '.tmp', parquet)
+            converted.append(parquet)
+
+    return converted
+
+def _ZeroToNaN(data):
+    """
+    Replace 0 by NaN in the numeric columns of a dataframe
+    """
+    numeric = data.select_dtypes(include='number').columns
+    data[numeric] = data[numeric].replace(0, np.nan)
+    return data
+
+def _TrieRegex(names):
+    """
+    Compile names into one regex matching any of them as substring
+
+    The names are merged into a prefix tree first so that the regex engine
+    compares common prefixes only once instead of trying every name at every
+    position.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        # the end of a name, longer names with the same prefix are redundant
+        node.clear()
+        node[''] = True
+
+    def pattern(node):
+        if '' in node:
+            return ''
+        alternatives = [re.escape(char) + pattern(child)
+                        for char, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')'
+
+    return re.compile(pattern(trie))
+
+def MatchProteinIDs(ids, target_gene_names, exact_match=False):
+    """
+    Return which protein IDs contain any of the target names
+
+    Keyword arguments:
+    ids -- Protein IDs column (pandas series, may be categorical)
+    target_gene_names -- list of full or partly Protein IDs to look for
+    exact_match -- only accept names equal to one of the ; separated IDs
+    instead of any substring match
+
+    Returns:
+    mask -- boolean numpy array, False for missing IDs
+    """
+    ids = pd.Series(ids)
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        # match every distinct value once
+        codes = ids.cat.codes.values
+        values = pd.Series(ids.cat.categories, dtype=object)
+    else:
+        codes = None
+        values = ids.astype(object).reset_index(drop=True)
+    if len(target_gene_names) == 0:
+        mask = np.zeros(len(values), dtype=bool)
+    elif exact_match:
+        # one row per ; separated ID, pointing back to its value
+        tokens = values.where(values.map(lambda x: isinstance(x, str)))\
+            .str.split(';').explode()
+        mask = tokens.isin(set(target_gene_names)).groupby(level=0).any()\
+            .reindex(range(len(values)), fill_value=False).values
+    else:
+        strings = values.where(values.map(lambda x: isinstance(x, str)))
+        mask = strings.str.contains(_TrieRegex(target_gene_names),
+                                    na=False).values.astype(bool)
+
+    if codes is not None:
+        mask = np.append(mask, False)[codes]
+    return mask
 
 def calc_rel_iBAQ(file, titles, target_gene_names, normalise_to=None,
-                  imputation = False):
+                  imputation = False, project = False, exact_match = False,
+                  seed = None, save_info = True, return_info = False):
     """
     Calculate the relative iBAQ value of a MaxQuant output.
 
@@ -24,21 +284,27 @@ def calc_rel_iBAQ(file, titles, target_gene_names, normalise_to=None,
     analysis, set to None for all genes
     normalise_to -- gene name to normalise iBAQs to. NOrmalised to total iBAQ
     if None
-    imputation -- impute zeros by normal distribution sampling (True or False)
+    imputation -- impute zeros by normal distribution sampling (True or False),
+    every missing iBAQ gets its own draw
+    project -- only read the Protein IDs, Reverse, Potential contaminant and
+    iBAQ columns of titles (True or False)
+    exact_match -- only accept target names equal to one of the ; separated
+    Protein IDs instead of any substring match (True or False)
+    seed -- seed of the random number generator used for imputation
+    save_info -- write the imputation statistics and histograms to
+    ImputationInfo.csv and ImputationInfo.pdf (True or False)
+    return_info -- also return the imputation statistics and histograms
+    (see ImputationInfo, None without imputation) (True or False)
     """
 
-    # turn off warnings for chained dataframe assignments
-    # this is raised by the append to dataframe operation in the last 2
-    # lines of this function
-    pd.options.mode.chained_assignment = None  # default='warn'
-
     # for pandas read_csv doc see
     # http://pandas.pydata.org/pandas-docs/stable/generated/pandas.read_csv.html
     # returns a pandas dataframe object
-    data = pd.read_csv(os.getcwd() + os.path.sep + file, sep='\t')
+    data = ReadMaxQuantTable(os.getcwd() + os.path.sep + file,
+                             usecols=MaxQuantColumns(titles) if project else None)
 
     # replace 0 by NaN
-    data.replace(0, np.nan, inplace=True)
+    data = _ZeroToNaN(data)
     # use the Protein IDs as index
     data.set_index(data['Protein IDs'], inplace=True)
 
@@ -58,128 +324,181 @@ def calc_rel_iBAQ(file, titles, target_gene_names, normalise_to=None,
     # Only return a subset of genes of interest if variable is set
     # else calculate relativie iBAQs for the whole dataset
     if target_gene_names != None:
-        # generate a Protein IDs list to filter
-        accepted = []
-        for element in filtered['Protein IDs']:
-            if isinstance(element, str):
-                for gene_name in target_gene_names:
-                    if gene_name in element:
-                        accepted.append(element)
-    
+        # match all names at once against the Protein IDs
+        accepted = MatchProteinIDs(filtered['Protein IDs'], target_gene_names,
+                                   exact_match)
+
         # reduce the filtered list to just the Pex-Proteins
-        trgt_genes = filtered[filtered['Protein IDs'].isin(accepted)]
+        trgt_genes = filtered[accepted]
     else:
         trgt_genes = filtered
 
-    if imputation:
-
-        # generate a copy of pex proteins to work on
-        t = trgt_genes
-
-        # initialise series to collect data
-        mean_full = pd.Series()
-        std_full = pd.Series()
-        mean_subset = pd.Series()
-        std_subset = pd.Series()
-
-        # initialise the figure object
-        fig, ax = plt.subplots(1, len(titles), sharex=True, sharey=True, squeeze=False)
-
-        for idx, title in enumerate(titles):
+    # the iBAQs of all experiments as one matrix, one column per title
+    columns = ['iBAQ %s' % title for title in titles]
+    ibaq = trgt_genes[columns].to_numpy(dtype=np.float64, copy=True)
 
-            ax[0][idx].set_title(title)
-            ax[0][idx].set_xlabel('Log2 iBAQ')
-            
-
-            # take log2 from the filtered data containing the iBAQs of interest
-            log2_iBAQs = np.log2(filtered["iBAQ %s" % title])
+    if imputation:
 
-            log2_iBAQs.plot.hist(bins=100,
-                                 range=(0, 40),
-                                 ax=ax[0][idx],
-                                 color='k',
-                                 alpha=0.5)
+        # impute in log2 space from the distributions of all filtered proteins
+        log2_filtered = np.log2(filtered[columns].to_numpy(dtype=np.float64))
+        log2_imputed, parameters = Imputation.PercentileImputer(
+            np.log2(ibaq), percentile=1, reference=log2_filtered, seed=seed)
+        ibaq = 2**log2_imputed
 
-            # calculate std and mean of original distribution
-            std_full[title] = log2_iBAQs.std()
-            mean_full[title] = log2_iBAQs.mean()
+        info = ImputationInfo(log2_filtered, parameters, titles)
+        if save_info:
+            SaveImputationInfo(info)
+    else:
+        info = None
 
-            # calculate the percentile for 1% of the data
-            quan = log2_iBAQs.quantile(q=0.01)
-            # define subset with less than 1% of the values
-            subset_iBAQs = log2_iBAQs[log2_iBAQs < quan]
+    # the totals always come from all filtered proteins, not only the targets
+    totals = np.nansum(filtered[columns].to_numpy(dtype=np.float64), axis=0)
 
-            subset_iBAQs.plot.hist(bins=100,
-                                   range=(0,40),
-                                   ax=ax[0][idx],
-                                   color = 'r')
+    # the input data is returned extended by the relative_iBAQ columns
+    # (and with the imputed iBAQs if imputation is used)
+    result = RelIBAQ(trgt_genes, titles, normalise_to=normalise_to,
+                     totals=totals, ibaq=ibaq if imputation else None)
 
-            # do some basic statistics to compute the distribution
-            std_subset[title] = subset_iBAQs.std()
-            mean_subset[title] = subset_iBAQs.mean()
+    if return_info:
+        return result, info
+    return result
 
-            # replace NaN by small numbers sampled from the quantile
-            t["iBAQ %s" % title].fillna(2**np.random.normal(loc=mean_subset[title],
-                                                            scale=std_subset[title]),
-                                        inplace=True)
+def ImputationInfo(log2_iBAQs, parameters, titles, bins=100, hist_range=(0, 40)):
+    """
+    Collect the statistics and histograms of an imputation without plotting
 
-        d = {'mean_full': mean_full,
-             'std_full': std_full,
-             'mean_subset': mean_subset,
-             'std_subset': std_subset}
+    Keyword arguments:
+    log2_iBAQs -- matrix (proteins x titles) of the log2 iBAQs the
+    distributions were taken from
+    parameters -- distributions per title, see Imputation.ImputationParameters
+    titles -- a list of expepriment names as given to MQ
+    bins -- number of histogram bins
+    hist_range -- (lower, upper) range of the histograms
+
+    Returns:
+    info -- dict with
+        statistics -- dataframe (titles x mean_full, std_full, mean_subset,
+        std_subset, quantile, missing)
+        edges -- bin edges of the histograms
+        full -- dataframe (titles x bins) of the counts of all values
+        subset -- dataframe (titles x bins) of the counts below the quantile
+    """
+    statistics = pd.DataFrame({key: parameters[key] for key in
+                               ['mean_full', 'std_full', 'mean_subset',
+                                'std_subset', 'quantile', 'missing']},
+                              index=titles)
+
+    edges = np.histogram_bin_edges([], bins=bins, range=hist_range)
+    full = np.zeros((len(titles), bins), dtype=np.int64)
+    subset = np.zeros((len(titles), bins), dtype=np.int64)
+    for idx in range(len(titles)):
+        values = log2_iBAQs[:, idx]
+        values = values[~np.isnan(values)]
+        full[idx] = np.histogram(values, bins=edges)[0]
+        subset[idx] = np.histogram(values[values < parameters['quantile'][idx]],
+                                   bins=edges)[0]
+
+    return {'statistics': statistics,
+            'edges': edges,
+            'full': pd.DataFrame(full, index=titles),
+            'subset': pd.DataFrame(subset, index=titles)}
+
+def PlotImputationInfo(info):
+    """
+    Plot the histograms of ImputationInfo, one panel per title
 
-        # create the dataframe
-        ImputationInfo = pd.DataFrame(d)
+    Returns:
+    fig -- matplotlib figure
+    """
+    import matplotlib.pyplot as plt
 
-        # save information
-        ImputationInfo.to_csv('ImputationInfo.csv')
-        plt.savefig('ImputationInfo.pdf')
+    titles = list(info['statistics'].index)
+    edges = info['edges']
 
-    else:
-        t = trgt_genes.fillna(0)
+    fig, ax = plt.subplots(1, len(titles), sharex=True, sharey=True, squeeze=False)
 
+    for idx, title in enumerate(titles):
 
-    # all relative iBAQ calculation is done in p while the results are returned
-    # as part of trgt_genes.
-    # Thus, the input data is returned extended by the relative_iBAQ column
+        ax[0][idx].set_title(title)
+        ax[0][idx].set_xlabel('Log2 iBAQ')
 
-    # manipulate the iBAQ values
-    for title in titles:
+        ax[0][idx].hist(edges[:-1], bins=edges, weights=info['full'].loc[title],
+                        color='k', alpha=0.5)
+        ax[0][idx].hist(edges[:-1], bins=edges, weights=info['subset'].loc[title],
+                        color='r')
 
-        if normalise_to:
+    return fig
 
-            # check if entry is available in data
-            if not t[t['Protein IDs'] == normalise_to].empty:
+def SaveImputationInfo(info, prefix='ImputationInfo'):
+    """
+    Write the statistics of ImputationInfo to <prefix>.csv and the plotted
+    histograms to <prefix>.pdf
+    """
+    import matplotlib.pyplot as plt
 
-                # dataframe query returns dataframe with one entry and NaNs
-                # reduce to single value by summing up
-                norm_iBAQ_t1 = t[t['Protein IDs'] == normalise_to]["iBAQ %s" % title].sum()
+    info['statistics'][['mean_full', 'std_full',
+                        'mean_subset', 'std_subset']].to_csv(prefix + '.csv')
 
-                # calculate the relative iBAQ values
-                rel_iBAQ_t1 = t["iBAQ %s" % title] / norm_iBAQ_t1
+    fig = PlotImputationInfo(info)
+    fig.savefig(prefix + '.pdf')
+    plt.close(fig)
 
-            else:
-                sys.exit("You provided a gene name to normalise to but" +
-                         "it doesnt exist in the data")
+def RelIBAQ(data, titles, normalise_to=None, totals=None, ibaq=None):
+    """
+    Calculate the relative iBAQs of all experiments at once as matrix
 
-        else:
-            # generate a total iBAQ by summing up the filtered iBAQs per title
-            total_iBAQ_t1 = filtered['iBAQ %s' % title].sum()
+    Missing iBAQs count as 0. The input dataframe is not modified.
 
-            # calculate the relative iBAQ values
-            rel_iBAQ_t1 = t["iBAQ %s" % title] / total_iBAQ_t1
+    Keyword arguments:
+    data -- dataframe with the Protein IDs and the iBAQ <title> columns
+    titles -- a list of expepriment names as given to MQ
+    normalise_to -- Protein IDs to normalise iBAQs to. Normalised to total
+    iBAQ if None
+    totals -- total iBAQ per title to normalise to, by default the sums of
+    the iBAQ columns of data
+    ibaq -- matrix (proteins x titles) of iBAQs to use instead of the iBAQ
+    columns of data, e.g. after imputation. It replaces them in the result.
+
+    Returns:
+    result -- copy of data extended by the rel_iBAQ_<title> columns
+    """
+    columns = ['iBAQ %s' % title for title in titles]
+    if ibaq is None:
+        matrix = data[columns].to_numpy(dtype=np.float64)
+    else:
+        matrix = np.asarray(ibaq, dtype=np.float64)
+    filled = np.where(np.isnan(matrix), 0, matrix)
+
+    if normalise_to:
+        # check if entry is available in data
+        reference = (data['Protein IDs'] == normalise_to).to_numpy(dtype=bool)
+        if not reference.any():
+            sys.exit("You provided a gene name to normalise to but" +
+                     "it doesnt exist in the data")
+        # sum up in case the reference occurs several times
+        norm = filled[reference].sum(axis=0)
+    elif totals is None:
+        norm = filled.sum(axis=0)
+    else:
+        norm = np.asarray(totals, dtype=np.float64)
 
-        # append to dataframe
-        trgt_genes["rel_iBAQ_%s" % title] = rel_iBAQ_t1
+    result = data.copy()
+    if ibaq is not None:
+        result[columns] = matrix
+    rel_iBAQ = pd.DataFrame(filled / norm, index=result.index,
+                            columns=['rel_iBAQ_%s' % title for title in titles])
 
-    return trgt_genes
+    return pd.concat([result, rel_iBAQ], axis=1)
 
-def ReadProteinGroups(file):
+def ReadProteinGroups(file, usecols=None):
     """
     Open a MaxQuant protein groups file and return it as pandas dataframe
+
+    Keyword arguments:
+    file -- path to proteinGroups.txt
+    usecols -- columns to read, see ReadMaxQuantTable
     """
-    pg = pd.read_csv(file,
-                   delimiter='\t')
+    pg = ReadMaxQuantTable(file, usecols=usecols)
 
     # avoid calculation a the inverse of an array of nans by checking first
     # if there are any reverse proteins in the data
@@ -195,7 +514,7 @@ def ReadProteinGroups(file):
     data = pg[remain].copy()
     
     # replace 0 by NaN
-    data.replace(0, np.nan, inplace=True)
+    data = _ZeroToNaN(data)
 
     return data
 
@@ -1,3 +1,75 @@
+def FastaAccession(header):
+    """
+    Return the ID of a fasta defline as used by ReadFasta
+
+    Keyword arguments:
+        header -- defline without the starting >
+
+    Returns:
+        accession -- part after the first vertical line if present (e.g. the
+        UniProt accession), else the whole defline
+    """
+    if '|' in header:
+        return header.split('|')[1]
+    return header.strip()
+
+
+def IterFasta(fname, chunksize=2**20):
+    """
+    Iterate over the entries of a multi-item fasta-file without loading it
+
+    The file is read in binary chunks and the lines of every sequence are
+    joined once at the end of the entry.
+
+    Keyword arguments:
+        fname -- path to fasta file
+        chunksize -- number of bytes read at once
+
+    Yields:
+        header -- defline without the starting >
+
+        sequence -- sequence without line breaks
+    """
+    header = None
+    blocks = []
+
+    def entry():
+        sequence = b''.join(blocks).translate(None, b' \t\r\n')
+        return header.decode('utf-8', 'replace').strip(), sequence.decode('ascii')
+
+    with open(fname, 'rb') as f:
+        rest = b''
+        while True:
+            chunk = f.read(chunksize)
+            data = rest + chunk
+            if chunk:
+                # only handle complete lines, keep the rest for the next chunk
+                cut = data.rfind(b'\n') + 1
+                data, rest = data[:cut], data[cut:]
+            pos = 0
+            while pos < len(data):
+                if data.startswith(b'>', pos):
+                    eol = data.find(b'\n', pos)
+                    eol = len(data) if eol == -1 else eol
+                    if header is not None:
+                        yield entry()
+                    header = data[pos+1:eol]
+                    blocks = []
+                    pos = eol + 1
+                else:
+                    # all sequence lines up to the next defline at once
+                    end = data.find(b'\n>', pos)
+                    end = len(data) if end == -1 else end + 1
+                    if header is not None:
+                        blocks.append(data[pos:end])
+                    pos = end
+            if not chunk:
+                break
+
+    if header is not None:
+        yield entry()
+
+
 def ReadFasta(fname):
     """
     Returns ID and sequence from a multi-item fasta-file
@@ -10,43 +82,159 @@ def ReadFasta(fname):
         
         sequences -- Sequences of the proteins as list
     """
-    with open(fname, 'r') as f:
-        
-        # initialise lists
-        ID_list = []
-        sequence_list = []
-        
-        # initialise sequence as boolean
-        sequence = None
-        
-        # read all lines from file
-        for line in f.readlines():
-            line = line.strip()
-            # the > is the identifier for a defline
-            if line.startswith('>'):
-                # use the inherent booleaness of string
-                # every string is automatically a boolean TRUE
-                if sequence:
-                    sequence_list.append(sequence)  
-                if '|' in line:
-                    # take the part after the vertical line if present
-                    ID = line.split('|')[1]
-                else:
-                    # else take the whole line without the tarting >
-                    ID = line.strip()[1:]
-                    
-                # add the ID to the list of IDs
-                ID_list.append(ID)    
-                    
-                # only initialise sequence if an ID has be found before
-                sequence = ''
-            else:
-                # append the line to the sequence
-                sequence += line
-        
-        sequence_list.append(sequence) # append the last sequence
+    ID_list = []
+    sequence_list = []
+
+    for header, sequence in IterFasta(fname):
+        ID_list.append(FastaAccession(header))
+        sequence_list.append(sequence)
+
+    return ID_list, sequence_list
+
+
+def _FastaIndexPath(fname):
+    """
+    Return the path of the index of a fasta-file
+    """
+    return fname + '.acc.fai'
+
+
+def IndexFasta(fname):
+    """
+    Write a .fai-style index of a fasta-file next to it and return it
+
+    The index is a tab separated file <fname>.acc.fai with one line per entry:
+    accession (see FastaAccession), sequence length, byte offset of the
+    sequence, residues per line, bytes per line and byte offset of the
+    defline. Residues and bytes per line are 0 if the lines of an entry
+    differ in length or contain blank lines or whitespace. If an accession occurs several times the first entry
+    is indexed.
+
+    Keyword arguments:
+        fname -- path to fasta file
+
+    Returns:
+        index -- dict mapping accessions to (length, offset, linebases,
+        linewidth, header_offset)
+    """
+    index = {}
+    rows = []
+
+    def finish(entry):
+        accession, header_offset, offset, length, lines, regular = entry
+        # blank lines after the sequence do not change its byte range
+        while lines and lines[-1][0] == 0:
+            lines.pop()
+        # all lines but the last must have the same length, a blank line
+        # within the sequence makes the layout irregular
+        widths = set(lines[:-1])
+        if regular and len(widths) <= 1 and\
+           (not widths or 0 < lines[-1][0] <= lines[0][0]):
+            linebases, linewidth = lines[0] if lines else (0, 0)
+        else:
+            linebases, linewidth = 0, 0
+        if accession not in index:
+            index[accession] = (length, offset, linebases, linewidth,
+                                header_offset)
+            rows.append('\t'.join(str(x) for x in
+                                  (accession,) + index[accession]))
+
+    entry = None
+    pos = 0
+    with open(fname, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if entry is not None:
+                    finish(entry)
+                header = line[1:].decode('utf-8', 'replace').strip()
+                entry = [FastaAccession(header), pos, pos + len(line), 0, [],
+                         True]
+            elif entry is not None:
+                bases = len(line.translate(None, b' \t\r\n'))
+                entry[3] += bases
+                entry[4].append((bases, len(line)))
+                # whitespace within a line breaks the line layout
+                if bases != len(line.rstrip(b'\r\n')):
+                    entry[5] = False
+            pos += len(line)
+    if entry is not None:
+        finish(entry)
+
+    with open(_FastaIndexPath(fname), 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+
+    return index
+
+
+def LoadFastaIndex(fname):
+    """
+    Return the index of a fasta-file, it is (re)built by IndexFasta if it
+    is missing or older than the fasta-file
+
+    Keyword arguments:
+        fname -- path to fasta file
+
+    Returns:
+        index -- dict mapping accessions to (length, offset, linebases,
+        linewidth, header_offset)
+    """
+    import os
+
+    indexpath = _FastaIndexPath(fname)
+    if not os.path.isfile(indexpath) or\
+       os.path.getmtime(indexpath) < os.path.getmtime(fname):
+        return IndexFasta(fname)
+
+    index = {}
+    with open(indexpath, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 6:
+                return IndexFasta(fname)
+            index[fields[0]] = tuple(int(x) for x in fields[1:])
+    return index
+
+
+def FetchFasta(fname, accession, index=None):
+    """
+    Return a single entry of a fasta-file without reading the rest of it
+
+    Keyword arguments:
+        fname -- path to fasta file
+        accession -- ID of the entry (see FastaAccession)
+        index -- index as returned by LoadFastaIndex, loaded if None
+
+    Returns:
+        header -- defline without the starting >
+
+        sequence -- sequence without line breaks
+
+    Raises:
+        KeyError -- if the accession is not in the fasta-file
+    """
+    if index is None:
+        index = LoadFastaIndex(fname)
+    length, offset, linebases, linewidth, header_offset = index[accession]
+
+    with open(fname, 'rb') as f:
+        f.seek(header_offset)
+        header = f.readline()[1:].decode('utf-8', 'replace').strip()
+        f.seek(offset)
+        if linebases:
+            # the byte range of the sequence follows from the line layout
+            lines, remainder = divmod(length, linebases)
+            data = f.read(lines * linewidth + remainder)
+        else:
+            # irregular lines, read up to the next defline
+            blocks = []
+            for line in f:
+                if line.startswith(b'>'):
+                    break
+                blocks.append(line)
+            data = b''.join(blocks)
 
-        return ID_list, sequence_list
+    sequence = data.translate(None, b' \t\r\n').decode('ascii')
+    return header, sequence
 
 
 
@@ -105,5 +293,6 @@ def peptide_cutter(sequence, enzyme='trypsin'):
     if enzyme not in enzymes.keys():
         raise Exception('Please use one of these enzymes: {}'.format('\n- '.join(enzymes.keys())))
         
-    protein = re.sub(enzymes[enzyme],'\n', sequence)
+    # cleave behind every match, keeping the cleaved residue
+    protein = re.sub(enzymes[enzyme], lambda m: m.group(0) + '\n', sequence)
     return protein.split()
\ No newline at end of file
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 
 def ExtractPeakrangeAsList(fname, start=1, end='end', returntype='tuple',
-                           exclude=[(0, 0)], points='all'):
+                           exclude=[(0, 0)], points='all', grid=None,
+                           chunksize=64, exclude_by='id', cache=False):
     """
     Extract a range of spectra from an mzML file and return them
     -----------
@@ -21,17 +24,37 @@ def ExtractPeakrangeAsList(fname, start=1, end='end', returntype='tuple',
     returntype:
         sets the export formatting.
         tuple returns a tuple with (all_mz, all_intensity)\n
-        list returns a list of binary tuples [(mz, int), (mz, int), ...]\n
+        list returns the concatenated (mz, intensity) of all scans as
+        float64 numpy arrays\n
+        array returns the summed spectrum as numpy arrays (mz, intensity)
+        (same sums as tuple, see SumPeakArrays)\n
         tuple is required for digitizing
 
     exclude:
         takes a list of (start,end) tuples to be ignored during import.
+        Scans within [start, end) are skipped.
         Useful for removing of spraying errors.\n
 
+    exclude_by:
+        id if the exclusions are given as scan ids, time if they are given
+        as retention times in seconds
+
+    cache:
+        read the spectra from the binary cache of the file (see CacheRun)
+        instead of parsing the mzML. The cache is built on first use
+
     points:
         takes an integer number of points to extract within the spectrum.
         Useful to reduce computation time
 
+    grid:
+        only used with returntype array. Bin edges of a fixed m/z grid to
+        sum the spectra onto, default None sums at identical m/z values
+
+    chunksize:
+        number of scans held in memory at once for the list and array
+        exports
+
     Returns: mzlist, intlist
         mzlist: m/z coordinate\n
         intlist: intensity
@@ -41,7 +64,10 @@ def ExtractPeakrangeAsList(fname, start=1, end='end', returntype='tuple',
     import numpy as np
 
     try:
-        msrun = pymzml.run.Reader(fname)
+        if cache:
+            msrun = CacheRun(fname)
+        else:
+            msrun = pymzml.run.Reader(fname)
     except:
         print('You must provide a valid filename')
         return
@@ -77,41 +103,519 @@ def ExtractPeakrangeAsList(fname, start=1, end='end', returntype='tuple',
         PointsInExtraction = int(end) - int(start)   
 
     SpectraToExtract = np.linspace(start,end,PointsInExtraction)
-    SpectraToExtract = [int(round(r, 0)) for r in SpectraToExtract]
-
-    if returntype == 'tuple':
-        peakslist = []
-        for i in SpectraToExtract:
-            actual_peak = msrun[i].peaks
-            peakslist.append(actual_peak)
+    SpectraToExtract = np.round(SpectraToExtract).astype(int)
+
+    # exclusion windows are compiled once and applied to all scans at once
+    windows = CompileExclusions(exclude)
+    if exclude_by == 'id':
+        SpectraToExtract = SpectraToExtract[~ExclusionMask(SpectraToExtract,
+                                                           windows)]
+        rt_windows = None
+    elif exclude_by == 'time':
+        rt_windows = windows
+    else:
+        print('valid exclusion options are id or time!')
+        return
 
-        results = {}
+    chunks = IterScanChunks(msrun, SpectraToExtract, chunksize=chunksize,
+                            rt_windows=rt_windows)
 
-        for peaks in peakslist:
-            for key, value in peaks:
-                results[key] = results.get(key, 0) + value
+    if returntype == 'tuple':
+        mz, intens = SumScanChunks(chunks)
 
-        results = list(results.items())
+        return list(zip(mz.tolist(), intens.tolist()))
 
-        return sorted(results)
+    elif returntype == 'array':
+        return SumScanChunks(chunks, grid=grid)
 
     elif returntype == 'list':
-        mzlist = []
-        intlist = []
-        for i in SpectraToExtract:
-            for exclusion in exclude:
-                if i not in range(exclusion[0], exclusion[1]):
-                    for j in msrun[i].mz:
-                        mzlist.append(j)
-                    for k in msrun[i].i:
-                        intlist.append(k)
-
-        return mzlist, intlist
+        return ConcatenateScanChunks(chunks)
     else:
-        print('valid export options are list or tuple!')
+        print('valid export options are list, tuple or array!')
         return
 
 
+def SumPeakArrays(mz_arrays, int_arrays, grid=None):
+    """
+    Sum a set of spectra given as arrays into a single spectrum
+    -----------
+
+    All scans are concatenated and reduced at once instead of adding up
+    every peak in a dictionary. Without a grid the intensities of identical
+    m/z values are summed, which gives the same result as the tuple export
+    of ExtractPeakrangeAsList.
+
+    Keyword arguments:
+        mz_arrays -- list of m/z arrays, one per scan\n
+        int_arrays -- list of intensity arrays in the same order\n
+        grid -- optional sorted bin edges; peaks are summed into the bins
+        [grid[n], grid[n+1]) and peaks outside the grid are dropped
+
+    Returns: mz, intensity
+        mz: sorted m/z values as numpy array (left bin edges with grid)\n
+        intensity: summed intensities as float64 numpy array
+    """
+
+    import numpy as np
+
+    if len(mz_arrays) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    mz = np.concatenate([np.asarray(m, dtype=np.float64) for m in mz_arrays])
+    intens = np.concatenate([np.asarray(i, dtype=np.float64)
+                             for i in int_arrays])
+
+    if grid is not None:
+        bins, counts, occupied = _BinOnGrid(mz, intens, grid)
+        return bins, counts
+
+    # np.unique sorts the m/z values, inverse maps every peak to its slot
+    unique_mz, inverse = np.unique(mz, return_inverse=True)
+    # bincount adds the weights in input order just like the dict did
+    summed = np.bincount(inverse.ravel(), weights=intens,
+                         minlength=unique_mz.size)
+
+    return unique_mz, summed
+
+
+def IterScanChunks(msrun, scans, chunksize=64, rt_windows=None):
+    """
+    Generator over the peaks of a set of scans
+    -----------
+
+    Reads the scans from an opened run and yields them in chunks so that
+    only chunksize scans are held in memory at any time.
+
+    Keyword arguments:
+        msrun -- opened pymzml run or CachedRun\n
+        scans -- iterable of scan ids to read\n
+        chunksize -- number of scans per chunk\n
+        rt_windows -- optional compiled retention time windows (seconds)
+        to skip, see CompileExclusions
+
+    Yields:
+        list of (mz, intensity) float64 numpy array pairs, one per scan
+    """
+
+    import numpy as np
+
+    def emit(chunk, times):
+        if rt_windows is not None:
+            keep = ~ExclusionMask(np.array(times), rt_windows)
+            chunk = [pair for pair, k in zip(chunk, keep) if k]
+        return chunk
+
+    if isinstance(msrun, CachedRun):
+        # slice the memory mapped arrays directly, no spectrum objects
+        scans = np.asarray(scans)
+        for n in range(0, scans.size, chunksize):
+            positions = msrun.position(scans[n:n + chunksize])
+            if rt_windows is not None:
+                positions = positions[~ExclusionMask(msrun.rt[positions],
+                                                     rt_windows)]
+            chunk = [msrun.peaks_at(p) for p in positions]
+            if chunk:
+                yield chunk
+        return
+
+    chunk = []
+    times = []
+    for i in scans:
+        spectrum = msrun[int(i)]
+        if rt_windows is not None:
+            times.append(spectrum['scan start time'] * 60)
+        chunk.append((np.asarray(spectrum.mz, dtype=np.float64),
+                      np.asarray(spectrum.i, dtype=np.float64)))
+        if len(chunk) == chunksize:
+            chunk = emit(chunk, times)
+            if chunk:
+                yield chunk
+            chunk = []
+            times = []
+    chunk = emit(chunk, times)
+    if chunk:
+        yield chunk
+
+
+class CachedRun(object):
+    """
+    Columnar binary copy of an mzML file, see CacheRun
+
+    Attributes:
+        mz, intensity -- memory mapped float64 arrays of all peaks\n
+        offsets -- start of every scan within mz and intensity, the scan
+        at position n covers offsets[n]:offsets[n+1]\n
+        scan_id -- id of every scan\n
+        rt -- retention time of every scan in seconds\n
+        tic -- total ion current of every scan\n
+        ms_level -- ms level of every scan\n
+        info -- dict with spectrum_count like a pymzml run
+    """
+
+    def __init__(self, path):
+        import numpy as np
+
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.scan_id = index['scan_id']
+        self.offsets = index['offsets']
+        self.rt = index['rt']
+        self.tic = index['tic']
+        self.ms_level = index['ms_level']
+
+        npeaks = int(self.offsets[-1])
+        if npeaks > 0:
+            self.mz = np.memmap(os.path.join(path, 'mz.f8'), mode='r',
+                                dtype=np.float64, shape=(npeaks,))
+            self.intensity = np.memmap(os.path.join(path, 'intensity.f8'),
+                                       mode='r', dtype=np.float64,
+                                       shape=(npeaks,))
+        else:
+            # numpy refuses to map empty files
+            self.mz = np.zeros(0)
+            self.intensity = np.zeros(0)
+
+        self._order = np.argsort(self.scan_id, kind='stable')
+        self.info = {'spectrum_count': self.scan_id.size,
+                     'filename': str(index['source'])}
+
+    def __len__(self):
+        return self.scan_id.size
+
+    def position(self, scans):
+        """
+        Return the positions of one or more scan ids within the cache
+        """
+        import numpy as np
+
+        scans = np.asarray(scans)
+        sorted_ids = self.scan_id[self._order]
+        inds = np.searchsorted(sorted_ids, scans)
+        inds = np.minimum(inds, sorted_ids.size - 1)
+        if sorted_ids.size == 0 or np.any(sorted_ids[inds] != scans):
+            raise KeyError('Scan id not found in {}'.format(
+                self.info['filename']))
+        return self._order[inds]
+
+    def peaks_at(self, position):
+        """
+        Return the (mz, intensity) arrays of the scan at a position without
+        copying them
+        """
+        start, stop = self.offsets[position], self.offsets[position + 1]
+        return self.mz[start:stop], self.intensity[start:stop]
+
+    def peaks(self, scan):
+        """
+        Return the (mz, intensity) arrays of a scan id without copying them
+        """
+        return self.peaks_at(int(self.position(scan)))
+
+
+def CacheRun(fname, cache_dir=None):
+    """
+    Return the binary cache of an mzML file, building it if necessary
+    -----------
+
+    On first use the mzML is parsed once and all peaks are written into
+    two flat float64 files plus an index of per-scan offsets, retention
+    times, TICs and ms levels. Later calls memory map these files, so the
+    spectra are read without any XML or base64 decoding.
+
+    The cache is keyed by the absolute path, size and modification time of
+    the mzML, so a changed file gets a new cache.
+
+    Keyword arguments:
+        fname -- name of input file (mzML)\n
+        cache_dir -- directory holding the caches, defaults to the
+        environment variable PYMS_CACHE or ~/.cache/PyMS
+
+    Returns:
+        CachedRun
+    """
+
+    import hashlib
+    import shutil
+    import tempfile
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('PYMS_CACHE',
+                                   os.path.join(os.path.expanduser('~'),
+                                                '.cache', 'PyMS'))
+
+    source = os.path.abspath(fname)
+    stat = os.stat(source)
+    key = '{}\0{}\0{}'.format(source, stat.st_size, stat.st_mtime_ns)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, '{}-{}'.format(os.path.basename(source),
+                                                  digest[:16]))
+
+    if not os.path.isfile(os.path.join(path, 'index.npz')):
+        os.makedirs(cache_dir, exist_ok=True)
+        # build in a temporary directory so that no half written cache
+        # is ever picked up by a concurrent process
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            _WriteRunCache(source, tmp)
+            os.replace(tmp, path)
+        except OSError:
+            # another process finished the same cache first
+            if not os.path.isfile(os.path.join(path, 'index.npz')):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    return CachedRun(path)
+
+
+def _WriteRunCache(fname, path):
+    """
+    Parse an mzML file once and write its columnar cache into path.
+    """
+
+    import pymzml
+    import numpy as np
+
+    print('Caching {}'.format(fname))
+
+    msrun = pymzml.run.Reader(fname)
+
+    scan_id = []
+    offsets = [0]
+    rt = []
+    tic = []
+    ms_level = []
+
+    with open(os.path.join(path, 'mz.f8'), 'wb') as mz_out, \
+            open(os.path.join(path, 'intensity.f8'), 'wb') as int_out:
+        for spectrum in msrun:
+            # removes entry 'TIC' on the last spectrum
+            if not isinstance(spectrum['id'], int):
+                continue
+
+            mz = np.asarray(spectrum.mz, dtype=np.float64)
+            intens = np.asarray(spectrum.i, dtype=np.float64)
+            mz.tofile(mz_out)
+            intens.tofile(int_out)
+
+            scan_id.append(spectrum['id'])
+            offsets.append(offsets[-1] + mz.size)
+            try:
+                rt.append(spectrum['scan start time'] * 60)
+            except KeyError:
+                rt.append(np.nan)
+            try:
+                tic.append(spectrum['total ion current'])
+            except KeyError:
+                tic.append(intens.sum())
+            try:
+                ms_level.append(spectrum['ms level'])
+            except KeyError:
+                ms_level.append(0)
+
+    np.savez(os.path.join(path, 'index.npz'),
+             scan_id=np.array(scan_id, dtype=np.int64),
+             offsets=np.array(offsets, dtype=np.int64),
+             rt=np.array(rt, dtype=np.float64),
+             tic=np.array(tic, dtype=np.float64),
+             ms_level=np.array(ms_level, dtype=np.int8),
+             source=np.array(fname))
+
+
+def CompileExclusions(exclude):
+    """
+    Compile a list of exclusion windows into a sorted interval index
+    -----------
+
+    Overlapping and touching windows are merged and empty windows such as
+    the default (0, 0) are dropped.
+
+    Keyword arguments:
+        exclude -- list of (start, end) tuples, each excluding [start, end)
+
+    Returns: starts, ends
+        sorted float64 arrays of the merged window boundaries
+    """
+
+    import numpy as np
+
+    windows = sorted((float(a), float(b)) for a, b in exclude if b > a)
+
+    starts = []
+    ends = []
+    for a, b in windows:
+        if starts and a <= ends[-1]:
+            ends[-1] = max(ends[-1], b)
+        else:
+            starts.append(a)
+            ends.append(b)
+
+    return np.array(starts), np.array(ends)
+
+
+def ExclusionMask(values, windows):
+    """
+    Return a boolean mask of the values lying within compiled exclusions
+    -----------
+
+    Keyword arguments:
+        values -- scan ids or retention times\n
+        windows -- (starts, ends) as returned by CompileExclusions
+    """
+
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    starts, ends = windows
+
+    if starts.size == 0:
+        return np.zeros(values.shape, dtype=bool)
+
+    # the last window starting at or before a value is the only candidate
+    inds = np.searchsorted(starts, values, side='right') - 1
+    return (inds >= 0) & (values < ends[np.maximum(inds, 0)])
+
+
+def ConcatenateScanChunks(chunks, capacity=2**20):
+    """
+    Collect the chunks of IterScanChunks into two contiguous arrays
+    -----------
+
+    The peaks are copied into preallocated float64 buffers which grow by
+    doubling, so no Python list of single peaks is ever built.
+
+    Keyword arguments:
+        chunks -- iterable of lists of (mz, intensity) array pairs\n
+        capacity -- initial number of peaks to allocate
+
+    Returns: mz, intensity
+        mz: m/z of all peaks in scan order\n
+        intensity: corresponding intensities
+    """
+
+    import numpy as np
+
+    mz_buffer = np.empty(capacity, dtype=np.float64)
+    int_buffer = np.empty(capacity, dtype=np.float64)
+    filled = 0
+
+    for chunk in chunks:
+        for mz, intens in chunk:
+            needed = filled + mz.size
+            if needed > mz_buffer.size:
+                newsize = max(needed, 2 * mz_buffer.size)
+                mz_buffer.resize(newsize, refcheck=False)
+                int_buffer.resize(newsize, refcheck=False)
+            mz_buffer[filled:needed] = mz
+            int_buffer[filled:needed] = intens
+            filled = needed
+
+    # release the unused part of the buffers
+    mz_buffer.resize(filled, refcheck=False)
+    int_buffer.resize(filled, refcheck=False)
+
+    return mz_buffer, int_buffer
+
+
+def SumScanChunks(chunks, grid=None):
+    """
+    Sum the chunks of IterScanChunks into a single spectrum
+    -----------
+
+    Every chunk is reduced right away and the reduced chunks are merged
+    pairwise by size, so memory is bounded by a few summed spectra. Without
+    a grid the sums equal SumPeakArrays over all scans up to floating point
+    rounding.
+
+    Keyword arguments:
+        chunks -- iterable of lists of (mz, intensity) array pairs\n
+        grid -- optional sorted bin edges, see SumPeakArrays
+
+    Returns: mz, intensity
+    """
+
+    import numpy as np
+
+    if grid is not None:
+        edges = np.asarray(grid, dtype=np.float64)
+        summed = np.zeros(edges.size - 1)
+        for chunk in chunks:
+            mz = np.concatenate([m for m, i in chunk])
+            intens = np.concatenate([i for m, i in chunk])
+            bins, counts, occupied = _BinOnGrid(mz, intens, edges)
+            summed += counts
+        return edges[:-1], summed
+
+    # reduced chunks waiting to be merged with the number of chunks they
+    # hold, the oldest first; sums of equally many chunks are merged like
+    # in a binary counter, so every chunk takes part in log2(chunks) merges
+    stack = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        stack.append((SumPeakArrays([m for m, i in chunk],
+                                    [i for m, i in chunk]), 1))
+        while len(stack) > 1 and stack[-2][1] == stack[-1][1]:
+            newer, n = stack.pop()
+            older, n = stack.pop()
+            stack.append((_MergeSums(older, newer), 2 * n))
+
+    if not stack:
+        return np.zeros(0), np.zeros(0)
+    summed_mz, summed = stack.pop()[0]
+    while stack:
+        summed_mz, summed = _MergeSums(stack.pop()[0], (summed_mz, summed))
+
+    return summed_mz, summed
+
+
+def _MergeSums(older, newer):
+    """
+    Merge two summed spectra given as (mz, intensity) with sorted unique m/z
+    values into one, adding the intensities of shared m/z values.
+    """
+
+    import numpy as np
+
+    mz = np.concatenate([older[0], newer[0]])
+    summed = np.concatenate([older[1], newer[1]])
+    # the stable sort merges the two sorted runs in linear time and keeps
+    # the older value first
+    order = np.argsort(mz, kind='stable')
+    mz = mz[order]
+    summed = summed[order]
+
+    first = np.ones(mz.size, dtype=bool)
+    first[1:] = mz[1:] != mz[:-1]
+    starts = np.flatnonzero(first)
+    if starts.size == 0:
+        return mz, summed
+
+    return mz[starts], np.add.reduceat(summed, starts)
+
+
+def _BinOnGrid(mz, intens, edges):
+    """
+    Sum intensities into the bins [edges[n], edges[n+1]) of a sorted grid.
+
+    Returns the left bin edges, the summed intensities and a boolean array
+    marking the bins that received at least one peak.
+    """
+
+    import numpy as np
+
+    edges = np.asarray(edges, dtype=np.float64)
+    nbins = edges.size - 1
+
+    inds = np.searchsorted(edges, mz, side='right') - 1
+    inside = (inds >= 0) & (inds < nbins)
+    inds = inds[inside]
+
+    counts = np.bincount(inds, weights=intens[inside], minlength=nbins)
+    occupied = np.bincount(inds, minlength=nbins) > 0
+
+    return edges[:-1], counts, occupied
+
+
 def PlotPeaklist(peaklist, start='start', end='end', inputtype='tuple', plot='show'):
     """
     Returns a graphical representation of a spectrum list of tuples
@@ -182,7 +686,7 @@ def PlotPeaklist(peaklist, start='start', end='end', inputtype='tuple', plot='sh
 
 def DigitizePeaklist(peaklist, resolution=0.5, debug=False,  sg = False,
                      inputtype='tuple',
-                     returntype='tuple'):
+                     returntype='tuple', grid=None, keep_empty=False):
     """
     Bin the list of peaks so that resolution decreases
     --------
@@ -192,59 +696,48 @@ def DigitizePeaklist(peaklist, resolution=0.5, debug=False,  sg = False,
         resolution -- size of the bins, default 0.5 \n
         debug -- True activates verbose output
         sg -- apply savitzky golay filtering
-        inputtype -- tuple or list
+        inputtype -- tuple or list (a pair of mz and intensity sequences,
+        numpy arrays are accepted)
         returntype -- tuple is a outputs two lists of mz and intensities, list
         outputs one list of tuples of mz, int
+        grid -- precomputed bin edges, e.g. from MzGrid. Overrides
+        resolution, peaks outside the grid are dropped
+        keep_empty -- return all bins of the grid including empty ones, so
+        that spectra binned on the same grid can be stacked directly
     """
     import numpy as np
     import sys
 
-    import savitzky_golay as sg
-
-
     if inputtype == 'tuple':
         mz_in, intens_in = zip(*peaklist)
 
-        mz = np.array(mz_in)
-        counts_double = np.array(intens_in)
+        mz = np.array(mz_in, dtype=np.float64)
+        counts_double = np.array(intens_in, dtype=np.float64)
     elif inputtype == 'list':
-        mz = np.array(peaklist[0])
-        counts_double = np.array(peaklist[1])
+        mz = np.asarray(peaklist[0], dtype=np.float64)
+        counts_double = np.asarray(peaklist[1], dtype=np.float64)
     else:
         sys.exit('You must provide a valid inputtype (list or tuple)')
 
-    bins = np.arange(0, max(mz) + 1, resolution)
-
-    inds = np.digitize(mz, bins)
+    if grid is None:
+        # the last bin is open towards higher m/z like with np.digitize
+        edges = np.append(MzGrid(0, mz.max() + 1, resolution)[:-1], np.inf)
+    else:
+        edges = np.asarray(grid, dtype=np.float64)
 
     if debug:
         print(mz)
-        print(bins)
-        for n in range(round(mz.size/resolution)):
-            print(bins[inds[n]-1], "<=", mz[n], "<", bins[inds[n]])
-
-    mz_bins_double = []
-    for m in range(mz.size):
-        mz_bins_double.append(bins[inds[m]-1])
-
-    mz_bins_double = np.array(mz_bins_double)
+        print(edges)
 
-    mz_counts_tuple = {}
-    for index, mass in enumerate(mz_bins_double):
-        if mass in mz_counts_tuple.keys():
-            mz_counts_tuple[mass] += counts_double[index]
-        else:
-            mz_counts_tuple[mass] = counts_double[index]
-
-    mz_bins = []
-    counts = []
+    mz_bins, counts, occupied = _BinOnGrid(mz, counts_double, edges)
 
-    for element in sorted(list(mz_counts_tuple.items())):
-        mz_bins.append(element[0])
-        counts.append(element[1])
+    if not keep_empty:
+        mz_bins = mz_bins[occupied]
+        counts = counts[occupied]
 
     if sg:
-        counts = sg.savitzky_golay(counts, 49, 3)
+        import savitzky_golay
+        counts = savitzky_golay.savitzky_golay(counts, 49, 3)
 
     if returntype == 'tuple':
         return mz_bins, counts
@@ -253,6 +746,27 @@ def DigitizePeaklist(peaklist, resolution=0.5, debug=False,  sg = False,
         return zip(mz_bins, counts)
 
 
+def MzGrid(start, end, resolution=0.5):
+    """
+    Return the bin edges of a fixed m/z grid for DigitizePeaklist
+    --------
+
+    The grid starts at start and covers end with bins of the given width.
+    Spectra binned with the same grid and keep_empty=True share their m/z
+    axis and can be stacked into a 2-D array with np.vstack.
+
+    Keyword arguments:
+        start -- lower edge of the first bin\n
+        end -- m/z that must be covered by the last bin\n
+        resolution -- size of the bins, default 0.5
+    """
+    import numpy as np
+
+    nbins = int(np.floor((end - start) / resolution)) + 1
+
+    return start + resolution * np.arange(nbins + 1)
+
+
 def ExportPeaklistToUnidec(peaklist, outdir, inputtype='tuple'):
 
     """
@@ -283,7 +797,114 @@ def ExportPeaklistToUnidec(peaklist, outdir, inputtype='tuple'):
     f.close()
 
 
-def DisplayTIC(fname, start=1, end='end', xaxis='time'):
+def ExtractChromatograms(fname, targets=(), ppm=10, ms_level=1,
+                         cache=False):
+    """
+    Extract TIC, BPC and any number of XICs in a single pass over a run
+    -----
+
+    Every scan is visited once. The XIC windows are sorted and located in
+    the scan with np.searchsorted, their intensities are taken from the
+    cumulative sum of the scan.
+
+    Keyword arguments:
+        fname -- name of input file (mzML)\n
+        targets -- m/z values to extract XICs for\n
+        ppm -- half width of the XIC windows in ppm, either one value or one
+        per target\n
+        ms_level -- only use scans of this ms level, None for all scans\n
+        cache -- read the run from the binary cache (see CacheRun)
+
+    Returns:
+        dict with numpy arrays
+        scan_id -- id of every used scan\n
+        time -- retention time in seconds\n
+        tic -- total ion current\n
+        bpc -- base peak intensity\n
+        targets -- the target m/z in the given order\n
+        xic -- array of shape (len(targets), len(scan_id)), one XIC per row
+    """
+
+    import pymzml
+    import numpy as np
+
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    tolerance = np.broadcast_to(np.asarray(ppm, dtype=np.float64),
+                                targets.shape) / 10**6
+
+    # sort the windows once, the results are reordered at the end
+    order = np.argsort(targets, kind='stable')
+    lower = (targets * (1 - tolerance))[order]
+    upper = (targets * (1 + tolerance))[order]
+
+    scan_id = []
+    time = []
+    tic = []
+    bpc = []
+    xic = []
+
+    def add_scan(mz, intens):
+        if mz.size > 1 and np.any(mz[1:] < mz[:-1]):
+            sorter = np.argsort(mz, kind='stable')
+            mz, intens = mz[sorter], intens[sorter]
+        cumulative = np.concatenate(([0.0], np.cumsum(intens)))
+        lo = np.searchsorted(mz, lower, side='left')
+        hi = np.searchsorted(mz, upper, side='right')
+        xic.append(cumulative[hi] - cumulative[lo])
+        bpc.append(intens.max() if intens.size else 0.0)
+
+    if cache:
+        msrun = CacheRun(fname)
+        if ms_level is None:
+            positions = np.arange(len(msrun))
+        else:
+            positions = np.nonzero(msrun.ms_level == ms_level)[0]
+        for p in positions:
+            add_scan(*msrun.peaks_at(p))
+        scan_id = msrun.scan_id[positions]
+        time = msrun.rt[positions]
+        tic = msrun.tic[positions]
+    else:
+        msrun = pymzml.run.Reader(fname)
+        for spectrum in msrun:
+            try:
+                # removes entry 'TIC' on the last spectrum
+                if not isinstance(spectrum['id'], int):
+                    continue
+                if ms_level is not None and \
+                        spectrum['ms level'] != ms_level:
+                    continue
+                rt = spectrum['scan start time'] * 60
+            except:
+                continue
+            mz = np.asarray(spectrum.mz, dtype=np.float64)
+            intens = np.asarray(spectrum.i, dtype=np.float64)
+            try:
+                tic.append(spectrum['total ion current'])
+            except:
+                tic.append(intens.sum())
+            scan_id.append(spectrum['id'])
+            time.append(rt)
+            add_scan(mz, intens)
+
+    if xic:
+        xic = np.array(xic).T
+    else:
+        xic = np.zeros((targets.size, 0))
+
+    # restore the order in which the targets were given
+    restored = np.empty_like(xic)
+    restored[order] = xic
+
+    return {'scan_id': np.asarray(scan_id),
+            'time': np.asarray(time, dtype=np.float64),
+            'tic': np.asarray(tic, dtype=np.float64),
+            'bpc': np.asarray(bpc, dtype=np.float64),
+            'targets': targets,
+            'xic': restored}
+
+
+def DisplayTIC(fname, start=1, end='end', xaxis='time', cache=False):
 
     """
     Displays the TIC of a file and indicates two positions
@@ -294,12 +915,13 @@ def DisplayTIC(fname, start=1, end='end', xaxis='time'):
         start -- position of the first marker\n
         end -- position of the second marker\n
         xaxis -- format of the x-axis; either time (time) or spectrum # (id)
+        cache -- read the TIC from the binary cache (see CacheRun)
     """
 
-    import pymzml
     import matplotlib.pyplot as plt
 
-    msrun = pymzml.run.Reader(fname)
+    chromatograms = ExtractChromatograms(fname, ms_level=None, cache=cache)
+    intensity = chromatograms['tic']
 
     if start == 'start':
         start = 1
@@ -307,90 +929,58 @@ def DisplayTIC(fname, start=1, end='end', xaxis='time'):
         start = int(start)
 
     if xaxis == 'time':
+        x = chromatograms['time']
+        xlabel = 'time[sec]'
+        end = x.max() if end == 'end' else int(end)
+    elif xaxis == 'id':
+        x = chromatograms['scan_id']
+        xlabel = 'scan id'
+        end = x.size if end == 'end' else int(end)
+    else:
+        print('valid xaxis options are time or id!')
+        return
 
-        if end == 'end':
-            # a random big number to fill the plot until the end
-            # an explicit endtime cannot be calculated before iterating
-            # over spectra
-            end = 10000000
-        else:
-            end = int(end)
-
-        time = []
-        intensity = []
-        for spectrum in msrun:
-            try:
-                time.append(spectrum['scan start time']*60)
-                intensity.append(spectrum['total ion current'])
-            except:
-                continue
-
-        print(start, end)
-
-        f, ax = plt.subplots()
-        ax.set_ylim([0, 1.1*max(intensity)])
-        ax.set_xlim([0, max(time)])
-        ax.add_patch(plt.Rectangle((start, 0), end-start, 1.1*max(intensity),
-                                   fc='#336699',  # foreground colour
-                                   ec='none'))  # edge colour
-        ax.plot(time, intensity, 'black')
-        ax.set_xlabel('time[sec]')
-        ax.set_ylabel('intensity')
-
-        f.tight_layout()
-        return f
-
-    if xaxis == 'id':
-
-        if end == 'end':
-            end = msrun.info['spectrum_count']
-        else:
-            end = int(end)
-
-        scan_id = []
-        intensity = []
-        for spectrum in msrun:
-            try:
-                # removes entry 'TIC' on the last spectrum
-                if isinstance(spectrum['id'], int):
-                    scan_id.append(spectrum['id'])
-                    intensity.append(spectrum['total ion current'])
-            except:
-                continue
+    f, ax = plt.subplots()
+    ax.set_ylim([0, 1.1*max(intensity)])
+    ax.set_xlim([0, max(x)])
+    # see   http://stackoverflow.com/questions/10665163/
+    #       draw-rectangle-add-patch-in-pylab-mode
+    ax.add_patch(plt.Rectangle((start, 0), end-start, 1.1*max(intensity),
+                               fc='#336699',  # foreground colour
+                               ec='none'))  # edge colour
+    ax.plot(x, intensity, 'black')
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel('intensity')
 
-        f, ax = plt.subplots()
-        ax.set_ylim([0, 1.1*max(intensity)])
-        ax.set_xlim([0, max(scan_id)])
-        # see   http://stackoverflow.com/questions/10665163/
-        #       draw-rectangle-add-patch-in-pylab-mode
-        ax.add_patch(plt.Rectangle((start, 0), end-start, 1.1*max(intensity),
-                                   fc='#336699',
-                                   ec='none'))
-        ax.plot(scan_id, intensity, 'black')
-        ax.set_xlabel('scan id')
-        ax.set_ylabel('intensity')
+    f.tight_layout()
+    return f
 
-        f.tight_layout()
-        return f
 
-def DisplayXIC(fname,mass2follow):
+def DisplayXIC(fname, mass2follow, ppm=10, ms_level=1, cache=False):
     """
-    under construction
+    Displays the XICs of one or more m/z values
+    -----
 
+    Keyword arguments:
+        fname -- name of input file (mzML)\n
+        mass2follow -- m/z or list of m/z to extract\n
+        ppm -- half width of the extraction windows in ppm\n
+        ms_level -- ms level of the scans to use\n
+        cache -- read the run from the binary cache (see CacheRun)
     """
 
-    import pymzml
-    import pylab as plt
-
-    try:
-        msrun = pymzml.run.Reader(fname)
-    except:
-        print('You must provide a valid filename')
-        return
+    import matplotlib.pyplot as plt
 
-    timeDependentIntensities = []
-    for spectrum in msrun:
-        if spectrum['ms level'] == 1:
-            for time in spectrum:
-                print(time)
+    chromatograms = ExtractChromatograms(fname, targets=mass2follow, ppm=ppm,
+                                         ms_level=ms_level, cache=cache)
 
+    f, ax = plt.subplots()
+    for target, xic in zip(chromatograms['targets'], chromatograms['xic']):
+        ax.plot(chromatograms['time'], xic,
+                label='{:.4f} \u00b1 {} ppm'.format(target, ppm))
+    ax.set_xlabel('time[sec]')
+    ax.set_ylabel('intensity')
+    ax.legend()
+
+    f.tight_layout()
+    return f
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the fasta reading and indexing of Sequences
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import Sequences as Seq
+
+FASTA = ('>sp|P1|A regular\nACDEFGHIK\nLMNPQRSTV\nWY\n'
+         '>sp|P2|B blank line within\nACDEFGHIK\n\nLMNPQRSTV\nWY\n'
+         '>sp|P3|C blank line after the defline\n\nACDEFGHIK\nWY\n'
+         '>sp|P4|D irregular lines\nACDEF\nGHIKLMNPQ\nRSTVWY\n'
+         '>sp|P5|E empty\n'
+         '>sp|P6|F windows line endings\r\nACDEFGHIK\r\nLM\r\n\r\n'
+         '>sp|P7|G whitespace within a line\nACDEF GHIK\nLMNPQRSTVW\nY\n'
+         '>P8 no trailing newline\nACDEFGHIK\nLM')
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    path = tmp_path / 'test.fasta'
+    path.write_bytes(FASTA.encode('ascii'))
+    return str(path)
+
+
+def test_IterFasta_matches_ReadFasta(fasta):
+    accessions, sequences = Seq.ReadFasta(fasta)
+    for chunksize in (3, 17, 2**20):
+        entries = list(Seq.IterFasta(fasta, chunksize=chunksize))
+        assert [Seq.FastaAccession(h) for h, s in entries] == accessions
+        assert [s for h, s in entries] == sequences
+    assert accessions == ['P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7',
+                          'P8 no trailing newline']
+    assert sequences[4] == ''
+
+
+def test_FetchFasta_matches_IterFasta(fasta):
+    index = Seq.LoadFastaIndex(fasta)
+    for header, sequence in Seq.IterFasta(fasta):
+        assert Seq.FetchFasta(fasta, Seq.FastaAccession(header), index) ==\
+            (header, sequence)
+
+
+def test_IndexFasta_blank_line_is_irregular(fasta):
+    index = Seq.IndexFasta(fasta)
+    assert index['P1'][2:4] == (9, 10)
+    assert index['P2'][2:4] == (0, 0)
+    assert index['P3'][2:4] == (0, 0)
+    assert index['P7'][2:4] == (0, 0)
+    assert Seq.FetchFasta(fasta, 'P2', index)[1] == 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def test_FetchFasta_missing_accession(fasta):
+    with pytest.raises(KeyError):
+        Seq.FetchFasta(fasta, 'P9')
@@ -1,3 +1,4 @@
 from .src import SpectrumAssignment
 from .src import SpectrumCalculations
-from .src import SpectrumReader
\ No newline at end of file
+from .src import SpectrumReader
+from .src import SpectrumMatching
\ No newline at end of file
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Annotate all CSMs of a cross-link result table (CroCo xtable, pLink, ...)
+against their spectra in a pool of worker processes.
+
+Run as module from the scripts directory, e.g.
+python -m SpecAn.src.BatchAnnotation xtable.csv mgf_dir scores.tsv
+"""
+import argparse
+import math
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import SpectrumAssignment as Assign
+from . import SpectrumReader as Reader
+
+# column names of the result table, defaults follow the CroCo xtable
+DEFAULT_COLUMNS = {'rawfile': 'RawFile',     # name of the mgf without .mgf
+                   'scan': 'Scan',           # scan number in the mgf
+                   'charge': 'Charge',       # precursor charge
+                   'peptide1': 'PepSeq1',
+                   'peptide2': 'PepSeq2',    # empty for linear peptides
+                   'xlink1': 'LinkPos1',     # position within peptide1
+                   'xlink2': 'LinkPos2',     # position within peptide2
+                   'modmass1': 'ModMass1',   # optional, ; separated
+                   'modpos1': 'ModPos1',     # optional, ; separated
+                   'modmass2': 'ModMass2',
+                   'modpos2': 'ModPos2'}
+
+# columns written to the output, one row per CSM
+SCORE_COLUMNS = ['Score',              # fraction of intensity explained
+                 'MatchedPeaks',       # peaks with at least one match
+                 'MatchedIons',        # theoretical ions with a match
+                 'TheoreticalIons',
+                 'MeanError',          # mean error of the matches in ppm
+                 'MedianAbsError',     # median absolute error in ppm
+                 'Error']              # reason if the CSM was not annotated
+
+
+def _IsEmpty(value):
+    """
+    Return True for missing table entries (NaN, None or empty string)
+    """
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    return str(value).strip() == ''
+
+
+def _ParseMods(masses, positions):
+    """
+    Convert ; separated mod masses and positions into [[mass, pos], ...]
+    """
+    if _IsEmpty(masses) or _IsEmpty(positions):
+        return []
+    masses = [float(m) for m in str(masses).split(';') if m.strip()]
+    positions = [int(float(p)) for p in str(positions).split(';') if p.strip()]
+    return [list(mod) for mod in zip(masses, positions)]
+
+
+def ScoreAssignment(spectrum, ions2desc, ppm):
+    """
+    Assign a spectrum and summarise the assignment in a few numbers
+
+    Args:
+        spectrum: list of lists of experimental mz and intensity
+        ions2desc: dict mapping theoretical mz to description
+        ppm: error allowed during assign in parts-per-million
+
+    Returns:
+        dict with the values of SCORE_COLUMNS
+    """
+    Assignments, matches = Assign.AssignPSM(spectrum, ions2desc, ppm)
+
+    intensity = np.asarray(spectrum[1], dtype=np.float64)
+    matched_peaks = np.unique(matches['peak'])
+    total = intensity.sum()
+
+    result = {'Score': intensity[matched_peaks].sum() / total if total else 0.0,
+              'MatchedPeaks': matched_peaks.size,
+              'MatchedIons': np.unique(matches['ion']).size,
+              'TheoreticalIons': len(ions2desc),
+              'MeanError': np.nan,
+              'MedianAbsError': np.nan,
+              'Error': ''}
+    if matches.size:
+        result['MeanError'] = matches['error_ppm'].mean()
+        result['MedianAbsError'] = np.median(np.abs(matches['error_ppm']))
+
+    return result, Assignments
+
+
+def _AnnotateMGF(mgf_path, records, settings):
+    """
+    Annotate a chunk of the CSMs belonging to one mgf file. Runs in a worker
+    process.
+
+    Args:
+        mgf_path: path to the indexed mgf file
+        records: list of (row index, dict of CSM values)
+        settings: dict of the keyword arguments of AnnotateResultTable
+
+    Returns:
+        list of (row index, dict with the values of SCORE_COLUMNS)
+    """
+    results = []
+
+    if not os.path.isfile(mgf_path):
+        error = 'mgf not found: {}'.format(mgf_path)
+        return [(idx, {'Error': error}) for idx, csm in records]
+
+    if settings['plot_dir'] is not None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+    # the mgf was indexed before, only fall back to indexing if it changed
+    with Reader.MGFFile(mgf_path, Reader.LoadIndex(mgf_path)) as mgf:
+        for idx, csm in records:
+            try:
+                scan = int(csm['scan'])
+                charge = [1, int(csm['charge'])]
+                spectrum = mgf[scan]
+
+                mods1 = _ParseMods(csm.get('modmass1'), csm.get('modpos1'))
+                mods2 = _ParseMods(csm.get('modmass2'), csm.get('modpos2'))
+
+                if _IsEmpty(csm.get('peptide2')):
+                    ions2desc = Assign.IonsFromSequence(csm['peptide1'],
+                                                        settings['ion_types'],
+                                                        charge,
+                                                        settings['mass_type'],
+                                                        settings['max_mass'],
+                                                        mods=mods1)
+                else:
+                    ions2desc = Assign.IonsFromXlinkSequence(csm['peptide1'],
+                                                             int(csm['xlink1']),
+                                                             csm['peptide2'],
+                                                             int(csm['xlink2']),
+                                                             settings['xlinker_mod'],
+                                                             settings['ion_types'],
+                                                             charge,
+                                                             settings['mass_type'],
+                                                             settings['max_mass'],
+                                                             mods1=mods1,
+                                                             mods2=mods2,
+                                                             verbose=False)
+
+                result, Assignments = ScoreAssignment(spectrum, ions2desc,
+                                                      settings['ppm'])
+            except Exception as e:
+                results.append((idx, {'Error': '{}: {}'.format(type(e).__name__, e)}))
+                continue
+
+            if settings['plot_dir'] is not None and Assignments['AssignmentMz']:
+                fig, ax = plt.subplots()
+                Assign.AssignAndPlotPSM(spectrum, ions2desc, settings['ppm'],
+                                        ax=ax)
+                ax.set_title('{} scan {}'.format(os.path.basename(mgf_path),
+                                                 scan))
+                fig.savefig(os.path.join(settings['plot_dir'],
+                                         '{}_{}.pdf'.format(
+                                             os.path.splitext(os.path.basename(mgf_path))[0],
+                                             scan)))
+                plt.close(fig)
+
+            results.append((idx, result))
+
+    return results
+
+
+def AnnotateResultTable(table_path, mgf_dir, out_path=None,
+                        xlinker_mod=138.068, ion_types=['a', 'b', 'y'],
+                        mass_type='monoisotopic', max_mass=2000,
+                        ppm=[-20, 20], columns=None, processes=None,
+                        chunksize=None, plot_dir=None):
+    """
+    Annotate every CSM of a cross-link result table
+
+    The CSMs are grouped by their mgf file and every mgf is indexed once.
+    The groups are split into chunks that are annotated in worker processes,
+    so the CSMs of a single large mgf are spread over all CPUs as well.
+
+    Args:
+        table_path: path of the result table (.csv or tab separated)
+        mgf_dir: directory containing the mgf files named after the rawfiles
+        out_path (optional): write the scores to this file, as parquet if
+                             it ends with .parquet, else tab separated
+        xlinker_mod: modification mass of the cross-linker
+        ion_types: list of which ions to generate (a/b/y)
+        mass_type: monoisotopic or average
+        max_mass: maximal mass to calculate ions from (e.g. max quad mass)
+        ppm: [lower, upper] error allowed during assign in parts-per-million
+        columns (optional): dict overriding entries of DEFAULT_COLUMNS
+        processes (optional): number of worker processes, default all CPUs
+        chunksize (optional): maximal number of CSMs per task, by default
+                              about four tasks per worker process
+        plot_dir (optional): save one annotated figure per CSM in this dir
+
+    Returns:
+        scores: DataFrame with the SCORE_COLUMNS for every row of the table
+    """
+    colmap = dict(DEFAULT_COLUMNS)
+    if columns is not None:
+        colmap.update(columns)
+
+    sep = ',' if table_path.lower().endswith('.csv') else '\t'
+    table = pd.read_csv(table_path, sep=sep)
+
+    if plot_dir is not None:
+        os.makedirs(plot_dir, exist_ok=True)
+
+    settings = {'xlinker_mod': xlinker_mod,
+                'ion_types': ion_types,
+                'mass_type': mass_type,
+                'max_mass': max_mass,
+                'ppm': ppm,
+                'plot_dir': plot_dir}
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, math.ceil(len(table) / (4 * processes)))
+
+    # only ship the columns needed for the annotation to the workers
+    present = {key: col for key, col in colmap.items() if col in table.columns}
+    tasks = []
+    n_mgf = 0
+    for rawfile, group in table.groupby(colmap['rawfile'], sort=False):
+        mgf_path = os.path.join(mgf_dir,
+                                os.path.splitext(str(rawfile))[0] + '.mgf')
+        # index every mgf once here, the workers only load the index
+        if os.path.isfile(mgf_path):
+            Reader.IndexMGF(mgf_path, processes)
+        n_mgf += 1
+        records = [(idx, {key: row[col] for key, col in present.items()})
+                   for idx, row in group.iterrows()]
+        for i in range(0, len(records), chunksize):
+            tasks.append((mgf_path, records[i:i+chunksize]))
+
+    print('Annotating {} CSMs from {} mgf files in {} tasks'.format(
+        len(table), n_mgf, len(tasks)))
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for task_results in pool.map(_AnnotateMGF,
+                                     [t[0] for t in tasks],
+                                     [t[1] for t in tasks],
+                                     [settings] * len(tasks)):
+            results.update(task_results)
+
+    # build the table once, rows of failed CSMs only carry the Error
+    scores = pd.DataFrame.from_dict(results, orient='index')
+    scores = scores.reindex(index=table.index, columns=SCORE_COLUMNS)
+    scores[SCORE_COLUMNS[:-1]] = scores[SCORE_COLUMNS[:-1]].astype(np.float64)
+    scores['Error'] = scores['Error'].fillna('')
+
+    if out_path is not None:
+        if out_path.lower().endswith('.parquet'):
+            scores.to_parquet(out_path)
+        else:
+            scores.to_csv(out_path, sep='\t')
+
+    return scores
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Annotate all CSMs of a cross-link result table')
+    parser.add_argument('table', help='Path to the result table')
+    parser.add_argument('mgf_dir', help='Directory containing the mgf files')
+    parser.add_argument('out', help='Output path (.parquet or tab separated)')
+    parser.add_argument('-x', '--xlinker', type=float, default=138.068,
+                        help='Modification mass of the cross-linker')
+    parser.add_argument('-p', '--ppm', type=float, default=20,
+                        help='Error allowed during assignment in ppm')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes')
+    parser.add_argument('-c', '--chunksize', type=int, default=None,
+                        help='Maximal number of CSMs per task')
+    parser.add_argument('--plot_dir', default=None,
+                        help='Save one annotated spectrum per CSM into this dir')
+    args = parser.parse_args()
+
+    AnnotateResultTable(args.table, args.mgf_dir, args.out,
+                        xlinker_mod=args.xlinker,
+                        ppm=[-args.ppm, args.ppm],
+                        processes=args.jobs,
+                        chunksize=args.chunksize,
+                        plot_dir=args.plot_dir)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Fragment ion index over all peptides of a fasta-file for searching spectra
+without knowing their peptide beforehand (MSFragger-style)
+
+The digested peptides are sorted by mass and split into buckets of
+neighbouring masses. Within every bucket the singly charged fragments of all
+its peptides are sorted by m/z. A spectrum is scored against all peptides
+within its precursor window by looking up every peak in the buckets of the
+window and counting the fragments it shares with each peptide.
+"""
+import os
+import sys
+
+import numpy as np
+
+from . import SpectrumCalculations as Calc
+from . import SpectrumReader as Reader
+from .SpectrumAssignment import LoadAAMasses
+
+try:
+    from PyMS.modules import Sequences
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', '..', '..', 'modules'))
+    import Sequences
+
+# one row per candidate peptide of a spectrum
+CandidateDtype = np.dtype([('peptide', np.int64),     # index into FragmentIndex
+                           ('matched', np.int64),     # shared fragments
+                           ('intensity', np.float64), # summed peak intensity
+                           ('delta_mass', np.float64)])  # observed - theor. mass
+
+# one row per reported candidate of a search
+SearchResultDtype = np.dtype([('scan', np.int64),
+                              ('rank', np.int64)] + CandidateDtype.descr)
+
+
+def DigestFasta(fasta_path, enzyme='trypsin', missed_cleavages=1,
+                min_length=7, max_length=40):
+    """
+    Digest all proteins of a fasta-file
+
+    Args:
+        fasta_path: path to the fasta-file
+        enzyme: enzyme as known by Sequences.peptide_cutter
+        missed_cleavages: maximal number of missed cleavages per peptide
+        min_length: minimal number of residues of a peptide
+        max_length: maximal number of residues of a peptide
+
+    Returns:
+        accessions: list of the protein IDs
+        peptide2proteins: dict mapping every unique peptide to the indices
+                          of the proteins it occurs in
+    """
+    accessions = []
+    peptide2proteins = {}
+    for idx, (header, sequence) in enumerate(Sequences.IterFasta(fasta_path)):
+        accessions.append(Sequences.FastaAccession(header))
+        pieces = Sequences.peptide_cutter(sequence.upper(), enzyme)
+        for i in range(len(pieces)):
+            peptide = ''
+            for piece in pieces[i:i+missed_cleavages+1]:
+                peptide += piece
+                if len(peptide) > max_length:
+                    break
+                if len(peptide) >= min_length:
+                    proteins = peptide2proteins.setdefault(peptide, [])
+                    if not proteins or proteins[-1] != idx:
+                        proteins.append(idx)
+
+    return accessions, peptide2proteins
+
+
+class FragmentIndex(object):
+    """
+    Sorted and bucketed fragment ion index of a digested fasta-file
+
+    All arrays are kept in memory. Fragment m/z are stored as float32 (about
+    0.1 ppm precision at m/z 2000) with an int32 peptide index, i.e. 8 bytes
+    per fragment.
+
+    Usage:
+        index = FragmentIndex('uniprot_human.fasta')
+        candidates = index.score(mz, intensity, pepmass, charge)
+        index.peptide(candidates['peptide'][0])
+    """
+
+    def __init__(self, fasta_path, enzyme='trypsin', missed_cleavages=1,
+                 min_length=7, max_length=40, ion_types=['b', 'y'],
+                 mass_type='monoisotopic', fixed_mods={'C': 57.02146},
+                 bucket_size=8192):
+        """
+        Args:
+            fasta_path: path to the fasta-file
+            enzyme: enzyme as known by Sequences.peptide_cutter
+            missed_cleavages: maximal number of missed cleavages per peptide
+            min_length: minimal number of residues of a peptide
+            max_length: maximal number of residues of a peptide
+            ion_types: list of which ions to index (a/b/y)
+            mass_type: monoisotopic or average
+            fixed_mods: dict mapping residues to the mass added to them
+            bucket_size: number of peptides of neighbouring mass per bucket
+        """
+        aa_dict, aa_lookup = LoadAAMasses(mass_type)
+        aa_lookup = aa_lookup.copy()
+        for aa, mass in fixed_mods.items():
+            aa_lookup[ord(aa)] += mass
+
+        print('Digesting {}...'.format(fasta_path))
+        self.accessions, peptide2proteins = DigestFasta(fasta_path, enzyme,
+                                                         missed_cleavages,
+                                                         min_length,
+                                                         max_length)
+        peptides = list(peptide2proteins)
+
+        # all peptide sequences one after the other
+        self.residues = np.frombuffer(''.join(peptides).encode('ascii'),
+                                      dtype=np.uint8)
+        lengths = np.array([len(p) for p in peptides], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        residue_masses = aa_lookup[self.residues]
+
+        # neutral peptide masses, peptides with unknown residues are dropped
+        masses = np.add.reduceat(residue_masses, offsets) + 18.01528 if\
+            len(peptides) else np.zeros(0)
+        valid = np.flatnonzero(~np.isnan(masses))
+        order = valid[np.argsort(masses[valid], kind='stable')]
+
+        self.mass = masses[order]
+        self.offset = offsets[order]
+        self.length = lengths[order]
+        protein_lists = [peptide2proteins[peptides[i]] for i in order]
+        self.protein_ptr = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in protein_lists], out=self.protein_ptr[1:])
+        self.protein_ids = np.fromiter((i for p in protein_lists for i in p),
+                                       dtype=np.int32,
+                                       count=self.protein_ptr[-1])
+        del peptide2proteins, peptides, protein_lists
+
+        print('Indexing fragments of {} peptides...'.format(len(self.mass)))
+        self.bucket_size = bucket_size
+        n_buckets = -(-len(self.mass) // bucket_size)
+        frag_mz = []
+        frag_peptide = []
+        self.bucket_ptr = np.zeros(n_buckets + 1, dtype=np.int64)
+        for b in range(n_buckets):
+            mz, peptide = self._BucketFragments(
+                np.arange(b * bucket_size,
+                          min((b + 1) * bucket_size, len(self.mass))),
+                residue_masses, ion_types)
+            order = np.argsort(mz, kind='stable')
+            frag_mz.append(mz[order].astype(np.float32))
+            frag_peptide.append(peptide[order].astype(np.int32))
+            self.bucket_ptr[b+1] = self.bucket_ptr[b] + mz.size
+
+        self.frag_mz = np.concatenate(frag_mz) if frag_mz else\
+            np.zeros(0, dtype=np.float32)
+        self.frag_peptide = np.concatenate(frag_peptide) if frag_peptide else\
+            np.zeros(0, dtype=np.int32)
+
+    def _BucketFragments(self, peptides, residue_masses, ion_types):
+        """
+        Return the singly charged fragment m/z of a set of peptides and the
+        index of the peptide of every fragment
+        """
+        lengths = self.length[peptides]
+        # residues of the peptides one after the other
+        starts = np.cumsum(lengths) - lengths
+        within = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+        masses = residue_masses[np.repeat(self.offset[peptides], lengths) +
+                                within]
+        prefix = np.zeros(masses.size + 1)
+        np.cumsum(masses, out=prefix[1:])
+
+        # fragments of 1 to length-1 residues from either terminus
+        n_frags = lengths - 1
+        peptide = np.repeat(peptides, n_frags)
+        start = np.repeat(starts, n_frags)
+        end = np.repeat(starts + lengths, n_frags)
+        cut = start + 1 + np.arange(n_frags.sum()) -\
+            np.repeat(np.cumsum(n_frags) - n_frags, n_frags)
+
+        all_mz = []
+        for ion in ion_types:
+            if ion in ['a', 'b']:
+                sums = prefix[cut] - prefix[start]
+            else:
+                sums = prefix[end] - prefix[cut]
+            all_mz.append(sums + Calc._ION_OFFSETS[ion](1))
+
+        return np.concatenate(all_mz), np.tile(peptide, len(ion_types))
+
+    def __len__(self):
+        return len(self.mass)
+
+    def peptide(self, i):
+        """
+        Return the sequence of peptide i
+        """
+        return self.residues[self.offset[i]:self.offset[i] + self.length[i]]\
+            .tobytes().decode('ascii')
+
+    def proteins(self, i):
+        """
+        Return the accessions of all proteins containing peptide i
+        """
+        return [self.accessions[p] for p in
+                self.protein_ids[self.protein_ptr[i]:self.protein_ptr[i+1]]]
+
+    def candidates(self, mass, ppm=[-10, 10], window=None):
+        """
+        Return the range [first, last) of the peptides within the precursor
+        tolerance of a neutral mass
+
+        Args:
+            mass: observed neutral precursor mass
+            ppm: [lower, upper] error allowed for the precursor in ppm
+            window (optional): [lower, upper] allowed difference between
+                               observed and peptide mass in Da for open
+                               searches, overrides ppm
+        """
+        if window is not None:
+            lo, hi = mass - window[1], mass - window[0]
+        else:
+            lo, hi = mass / (1 + ppm[1] / 10**6), mass / (1 + ppm[0] / 10**6)
+        return (int(np.searchsorted(self.mass, lo, side='left')),
+                int(np.searchsorted(self.mass, hi, side='right')))
+
+    def score(self, mz, intensity, pepmass, charge, ppm=[-20, 20],
+              precursor_ppm=[-10, 10], window=None, top=10, min_matched=1):
+        """
+        Score a spectrum against all peptides within its precursor window by
+        the number of fragments they share with it
+
+        Fragments up to charge-1 are considered by converting every peak to
+        the m/z it would have if singly charged.
+
+        Args:
+            mz: array of the experimental m/z
+            intensity: array of the experimental intensities
+            pepmass: precursor m/z
+            charge: precursor charge
+            ppm: [lower, upper] error allowed for the fragments in ppm
+            precursor_ppm: [lower, upper] error allowed for the precursor
+            window (optional): open search window in Da, see candidates
+            top: number of best candidates to return
+            min_matched: minimal number of shared fragments of a candidate
+
+        Returns:
+            candidates: array of type CandidateDtype, best first
+        """
+        charge = max(int(charge), 1)
+        mass = (pepmass - 1.00794) * charge
+        first, last = self.candidates(mass, precursor_ppm, window)
+        if last <= first:
+            return np.zeros(0, dtype=CandidateDtype)
+
+        mz = np.asarray(mz, dtype=np.float64)
+        intensity = np.asarray(intensity, dtype=np.float64)
+        fragment_charges = np.arange(1, max(charge - 1, 1) + 1)[:, None]
+        peaks = (mz[None, :] * fragment_charges -
+                 (fragment_charges - 1) * 1.00794).ravel()
+        peak_intensity = np.tile(intensity, fragment_charges.size)
+        # fragments within [peak*(1+ppm[0]/10**6), peak*(1+ppm[1]/10**6)]
+        lo = peaks * (1 + ppm[0] / 10**6)
+        hi = peaks * (1 + ppm[1] / 10**6)
+
+        matched = np.zeros(last - first, dtype=np.int64)
+        summed = np.zeros(last - first)
+        for b in range(first // self.bucket_size,
+                       (last - 1) // self.bucket_size + 1):
+            frag_mz = self.frag_mz[self.bucket_ptr[b]:self.bucket_ptr[b+1]]
+            frag_peptide = self.frag_peptide[self.bucket_ptr[b]:
+                                             self.bucket_ptr[b+1]]
+            left = np.searchsorted(frag_mz, lo, side='left')
+            counts = np.searchsorted(frag_mz, hi, side='right') - left
+            hit = counts > 0
+            if not hit.any():
+                continue
+            counts = counts[hit]
+            # indices of all fragments within the windows of all peaks
+            fragments = np.repeat(left[hit], counts) +\
+                np.arange(counts.sum()) -\
+                np.repeat(np.cumsum(counts) - counts, counts)
+            peptides = frag_peptide[fragments].astype(np.int64)
+            weights = np.repeat(peak_intensity[hit], counts)
+            inside = (peptides >= first) & (peptides < last)
+            matched += np.bincount(peptides[inside] - first,
+                                   minlength=last - first)
+            summed += np.bincount(peptides[inside] - first,
+                                  weights=weights[inside],
+                                  minlength=last - first)
+
+        best = np.flatnonzero(matched >= min_matched)
+        best = best[np.lexsort((-summed[best], -matched[best]))][:top]
+
+        candidates = np.zeros(best.size, dtype=CandidateDtype)
+        candidates['peptide'] = best + first
+        candidates['matched'] = matched[best]
+        candidates['intensity'] = summed[best]
+        candidates['delta_mass'] = mass - self.mass[best + first]
+        return candidates
+
+
+def SearchMGF(index, mgf_path, top=1, **kwargs):
+    """
+    Score all spectra of an mgf-file against a FragmentIndex
+
+    Spectra without precursor m/z or charge are skipped.
+
+    Args:
+        index: FragmentIndex to search against
+        mgf_path: path of the mgf-file
+        top: number of candidates to report per spectrum
+        kwargs: further arguments of FragmentIndex.score
+
+    Returns:
+        results: array of type SearchResultDtype in file order
+    """
+    spectrum2offset = Reader.IndexMGF(mgf_path)
+    results = []
+    with open(mgf_path, 'rb') as f:
+        entries = np.asarray(spectrum2offset)
+        entries = entries[np.argsort(entries['offset'], kind='stable')]
+        for entry, (scan, mz, intens) in zip(entries,
+                                             Reader.IterSpectra(f, entries)):
+            if np.isnan(entry['pepmass']) or entry['charge'] <= 0:
+                continue
+            candidates = index.score(mz, intens, float(entry['pepmass']),
+                                     int(entry['charge']), top=top, **kwargs)
+            for rank, candidate in enumerate(candidates.tolist()):
+                results.append((scan, rank + 1) + candidate)
+
+    return np.array(results, dtype=SearchResultDtype)
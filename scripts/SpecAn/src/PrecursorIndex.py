@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Precursor mass index for enumerating the cross-linked peptide pairs that
+explain observed precursor masses
+
+The neutral masses of all single peptides (and their modified forms) are
+sorted once. For every observed mass M the pairs with
+m_alpha + m_beta + m_xlinker within the tolerance are then found by a
+searchsorted sweep: every alpha peptide with m_alpha <= m_beta selects the
+window of beta peptides that completes it, for many precursors at once.
+"""
+import numpy as np
+
+from . import SpectrumCalculations as Calc
+
+# one row per cross-linked pair explaining a precursor
+PairDtype = np.dtype([('precursor', np.int64),   # index into the masses
+                      ('alpha', np.int64),       # peptide index, lighter one
+                      ('beta', np.int64),        # peptide index
+                      ('alpha_mods', np.int64),  # number of variable mods
+                      ('beta_mods', np.int64),
+                      ('error_ppm', np.float64)])  # (observed - theor)/theor
+
+
+def PrecursorMasses(pepmass, charge):
+    """
+    Return neutral masses from precursor m/z and charges (e.g. the pepmass
+    and charge columns of an mgf index)
+    """
+    return (np.asarray(pepmass, dtype=np.float64) - 1.00794) *\
+        np.asarray(charge, dtype=np.float64)
+
+
+class PrecursorIndex(object):
+    """
+    Sorted single peptide masses for cross-link candidate enumeration
+
+    Usage:
+        index = PrecursorIndex(fragment_index.mass, xlinker_mod=138.068)
+        pairs = index.pairs(PrecursorMasses(mgf_index['pepmass'],
+                                            mgf_index['charge']))
+    """
+
+    def __init__(self, masses, xlinker_mod=138.068, sequences=None,
+                 variable_mods={}, max_mods=1):
+        """
+        Args:
+            masses: neutral masses of the peptides (incl. water and fixed
+                    modifications), e.g. FragmentIndex.mass
+            xlinker_mod: modification mass of the cross-linker
+            sequences (optional): sequences of the peptides, only needed for
+                                  variable_mods (list or callable returning
+                                  the sequence of a peptide index)
+            variable_mods (optional): dict mapping residues to the mass
+                                      added by a variable modification
+            max_mods: maximal number of variable modifications per peptide
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        self.xlinker_mod = xlinker_mod
+
+        peptide = [np.arange(masses.size)]
+        n_mods = [np.zeros(masses.size, dtype=np.int64)]
+        mass = [masses]
+        if variable_mods:
+            if sequences is None:
+                raise Exception('Variable modifications need the peptide sequences')
+            if not callable(sequences):
+                sequences = sequences.__getitem__
+            for aa, delta in variable_mods.items():
+                sites = np.array([sequences(i).count(aa)
+                                  for i in range(masses.size)])
+                for k in range(1, max_mods + 1):
+                    modified = np.flatnonzero(sites >= k)
+                    peptide.append(modified)
+                    n_mods.append(np.full(modified.size, k, dtype=np.int64))
+                    mass.append(masses[modified] + k * delta)
+
+        mass = np.concatenate(mass)
+        order = np.argsort(mass, kind='stable')
+        self.mass = mass[order]
+        self.peptide = np.concatenate(peptide)[order]
+        self.n_mods = np.concatenate(n_mods)[order]
+
+    def __len__(self):
+        return len(self.mass)
+
+    def iterpairs(self, masses, ppm=[-10, 10], block=2**22):
+        """
+        Enumerate all cross-linked pairs within the tolerance of observed
+        precursor masses block by block, so that the pairs of large searches
+        can be processed without holding all of them in memory
+
+        Args:
+            masses: observed neutral precursor masses, see PrecursorMasses
+            ppm: [lower, upper] error allowed for the precursor in ppm
+            block: maximal number of alpha candidates processed at once,
+                   bounds the memory of the sweep
+
+        Yields:
+            pairs: array of type PairDtype for a block of precursors
+        """
+        masses = np.atleast_1d(np.asarray(masses, dtype=np.float64))
+        # window of m_alpha + m_beta for every precursor
+        lo = masses / (1 + ppm[1] / 10**6) - self.xlinker_mod
+        hi = masses / (1 + ppm[0] / 10**6) - self.xlinker_mod
+        # the lighter peptide is alpha, so m_alpha <= hi/2
+        n_alpha = np.searchsorted(self.mass, hi / 2, side='right')
+
+        total = np.concatenate([[0], np.cumsum(n_alpha)])
+        start = 0
+        while start < masses.size:
+            # precursors of this block, at least one
+            stop = max(start + 1, int(np.searchsorted(
+                total, total[start] + block, side='right')) - 1)
+            counts = n_alpha[start:stop]
+            precursor = np.repeat(np.arange(start, stop), counts)
+            alpha = np.arange(counts.sum()) -\
+                np.repeat(np.cumsum(counts) - counts, counts)
+
+            remainder = self.mass[alpha]
+            first = np.searchsorted(self.mass, lo[precursor] - remainder,
+                                    side='left')
+            first = np.maximum(first, alpha)
+            last = np.searchsorted(self.mass, hi[precursor] - remainder,
+                                   side='right')
+            n_beta = last - first
+            hit = n_beta > 0
+            n_beta = n_beta[hit]
+            precursor = np.repeat(precursor[hit], n_beta)
+            beta = np.repeat(first[hit], n_beta) + np.arange(n_beta.sum()) -\
+                np.repeat(np.cumsum(n_beta) - n_beta, n_beta)
+            alpha = np.repeat(alpha[hit], n_beta)
+
+            pairs = np.empty(precursor.size, dtype=PairDtype)
+            pairs['precursor'] = precursor
+            pairs['alpha'] = self.peptide[alpha]
+            pairs['beta'] = self.peptide[beta]
+            pairs['alpha_mods'] = self.n_mods[alpha]
+            pairs['beta_mods'] = self.n_mods[beta]
+            theoretical = Calc.CrosslinkMass(self.mass[alpha], self.mass[beta],
+                                             self.xlinker_mod)
+            pairs['error_ppm'] = (masses[precursor] - theoretical) /\
+                theoretical * 10**6
+            yield pairs
+            start = stop
+
+    def pairs(self, masses, ppm=[-10, 10], block=2**22):
+        """
+        Enumerate all cross-linked pairs within the tolerance of observed
+        precursor masses, see iterpairs
+
+        Returns:
+            pairs: array of type PairDtype sorted by precursor
+        """
+        results = list(self.iterpairs(masses, ppm, block))
+        if not results:
+            return np.zeros(0, dtype=PairDtype)
+        return np.concatenate(results)
@@ -8,21 +8,71 @@ Created on Fri Oct 13 12:59:06 2017
 """
 import os
 
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-
 import csv
 import numpy as np
 
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-
 from . import SpectrumCalculations as Calc
+from . import SpectrumMatching as Match
 from . import SpectrumReader as Reader
-from . import XlinkPic
+
+# matplotlib is only imported by the plotting functions, so that ions can
+# be generated and assigned on headless machines
 
 # set the start for relative paths if script run in standalone
 binPath = '../../bin'
 
+# table contains amino acid masses - H2O for better calculation
+aaPath = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                      './config/aa_masses.txt')
+
+# parsed amino acid tables by mass type as (mtime, aa_dict, aa_lookup)
+_aa_tables = {}
+
+
+#%% Start of LoadAAMasses
+def LoadAAMasses(mass_type='monoisotopic'):
+    """
+    Return the amino acid masses from config/aa_masses.txt.
+    The table is parsed once per mass type and only read again after the
+    file has been modified.
+
+    Args:
+        mass_type: monoisotopic or average
+
+    Returns:
+        aa_dict: Dictionary mapping one-letter codes to residue masses
+        aa_lookup: read-only array of 256 masses indexed by the ASCII code
+                   of the residue, NaN for unknown residues
+
+    Raises:
+        FileNotFoundError: If the amino acid dict is not found
+    """
+    if mass_type not in ['monoisotopic', 'average']:
+        print('No mass_type specified, assuming monoisotopic masses')
+        mass_type = 'monoisotopic'
+
+    try:
+        mtime = os.stat(aaPath).st_mtime_ns
+    except OSError:
+        raise FileNotFoundError('aa_masses.txt not found')
+
+    if mass_type in _aa_tables and _aa_tables[mass_type][0] == mtime:
+        return _aa_tables[mass_type][1:]
+
+    column = 1 if mass_type == 'monoisotopic' else 2
+    with open(aaPath, mode='r') as infile:
+        reader = csv.reader(infile, delimiter='\t')
+        aa_dict = {rows[0]:float(rows[column]) for rows in reader}
+
+    aa_lookup = np.full(256, np.nan)
+    for aa, mass in aa_dict.items():
+        aa_lookup[ord(aa)] = mass
+    aa_lookup.setflags(write=False)
+
+    _aa_tables[mass_type] = (mtime, aa_dict, aa_lookup)
+
+    return aa_dict, aa_lookup
+
 
 #%% Start of IonsFromSequence
 def IonsFromSequence(sequence, ion_types, charge, mass_type, max_mass, mods=[]):
@@ -46,46 +96,13 @@ def IonsFromSequence(sequence, ion_types, charge, mass_type, max_mass, mods=[]):
         FileNotFoundError: If the amino acid dict is not found
     """
 
-    # table contains amino acid masses - H2O for better calculation
-    aaPath = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                          './config/aa_masses.txt')
-    try:
-        with open(aaPath, mode='r') as infile:
-            reader = csv.reader(infile, delimiter='\t')
-            if mass_type == 'monoisotopic':
-                aa_dict = {rows[0]:float(rows[1]) for rows in reader}
-            elif mass_type == 'average':
-                aa_dict = {rows[0]:float(rows[2]) for rows in reader}
-            else:
-                print('No mass_type specified, assuming monoisotopic masses')
-                aa_dict = {rows[0]:float(rows[1]) for rows in reader}
-    except:
-        raise FileNotFoundError('aa_masses.txt not found')
+    aa_dict, aa_lookup = LoadAAMasses(mass_type)
+
+    # all fragment ions from one cumulative sum over the residue masses
+    mz, table = Calc.FragmentLadder(sequence, aa_lookup, charge, ion_types, mods)
 
-    all_ions = []
-    all_desc = []
-
-    for pep in Calc.NTermPeptides(sequence):
-        if 'a' in ion_types:
-            for c in range(charge[0], charge[-1]+1):
-                mass, desc = Calc.AIonMass(pep, aa_dict, c, mods)
-                all_ions.append(mass)
-                all_desc.append(desc)
-        if 'b' in ion_types:
-            for c in range(charge[0], charge[-1]+1):
-                mass, desc = Calc.BIonMass(pep, aa_dict, c, mods)
-                all_ions.append(mass)
-                all_desc.append(desc)
-
-    for pep in Calc.CTermPeptides(sequence):
-        if 'y' in ion_types:
-            for c in range(charge[0], charge[-1]+1):
-                mass, desc = Calc.YIonMass(pep, aa_dict, c, mods=mods, peptide_len=(len(sequence)))
-                # print(sequence)
-                # print(len(sequence))
-                # print(desc)
-                all_ions.append(mass)
-                all_desc.append(desc)
+    all_ions = mz.tolist()
+    all_desc = Calc.LadderDescriptions(sequence, table, mods)
 
     for c in range(charge[0], charge[1]+1):
         mass, desc = Calc.ParentionMass(sequence, aa_dict, c, mods)
@@ -97,7 +114,7 @@ def IonsFromSequence(sequence, ion_types, charge, mass_type, max_mass, mods=[]):
     return ions2desc
 
 #%% Start of IonsFromXlinkSequence
-def IonsFromXlinkSequence(peptide1, xlink1, peptide2, xlink2, xlinker_mod, ion_types, charge, mass_type, max_mass, mods1=[], mods2=[]):
+def IonsFromXlinkSequence(peptide1, xlink1, peptide2, xlink2, xlinker_mod, ion_types, charge, mass_type, max_mass, mods1=[], mods2=[], verbose=True):
     """
     Calculates theoretical ions for an amino acid
     sequence with modifications.
@@ -114,191 +131,50 @@ def IonsFromXlinkSequence(peptide1, xlink1, peptide2, xlink2, xlinker_mod, ion_t
         mods1: variable modifications to consider in peptide1
         mods2: variable modifications to consider in pepetide2
         max_mass: maximum allowed mass (e.g. max m/z of quad)
+        verbose (optional): print the generated fragments and masses
         
     Returns:
         ions2desc: Dict mapping ion mz to description in the form [sequence, type, position,
               charge, peptide_type, Modifications]
     """
 
-    #%% CalcABIons
-    def CalcABions(peptides, peptide_type, ion_types, charge, aa_dict,
-                   xpepdesc, xpepmass, mods):
-        """
-        Calculate theoretical masses and corresponding descriptions
-        of a-ions for set of peptides sequences. Append the masses and descriptions
-        to all_ions and all_dessc if mass < max_mass
-
-        Args:
-            peptides: List of peptide sequences
-            peptide_type: string "alpha" or "beta" (first or last peptide truncated respectively)
-            ion_types: list of ion types to consider (e.g. ['b', 'y'])
-            charge: list of [min_charge, max_charge]
-            aa_dict: dict linking one-character ID to mass
-            xpepdesc: description to add to the xlinked peptides
-            xpepmass: mass of the cross-linker plus second peptide
-            mods: [[[mass1_1, mass2_1], [pos1_1, pos2_1]]
-        """
-        for pep in peptides:
-            if 'a' in ion_types:
-                for c in range(charge[0], charge[-1]+1):
-                    mass, desc = Calc.AIonMass(pep, aa_dict, c,
-                                                mods, peptide_type)
-                    if mass < max_mass:
-                        all_ions.append(mass + xpepmass/c) # treat second peptide as constant adduct
-                        desc[0] += xpepdesc
-                        all_desc.append(desc)
-
-            if 'b' in ion_types:
-                for c in range(charge[0], charge[-1]+1):
-                    mass, desc = Calc.BIonMass(pep, aa_dict, c,
-                                                mods, peptide_type)
-                    if mass < max_mass:
-                        all_ions.append(mass + xpepmass/c) # treat second peptide as constant adduct
-                        desc[0] += xpepdesc
-                        all_desc.append(desc)
-
-
-    #%% CalcYions
-    def CalcYions(peptides, peptide_type, ion_types, charge, aa_dict,
-                   xpepdesc, xpepmass, mods=[], peptide_len=None):
-        """
-        Calculate theoretical masses and corresponding descriptions
-        of y-ions for set of peptides sequences. Append the masses and descriptions
-        to all_ions and all_dessc if mass < max_mass
-
-        Args:
-            peptides: List of peptide sequences
-            peptide_type: string "alpha" or "beta" (first or last peptide truncated respectively)
-            ion_types: list of ion types to consider (e.g. ['b', 'y'])
-            charge: list of [min_charge, max_charge]
-            aa_dict: dict linking one-character ID to mass
-            xpepdesc: description to add to the xlinked peptides
-            xpepmass: mass of the cross-linker plus second peptide
-            mods: [[[mass1_1, mass2_1], [pos1_1, pos2_1]]
-        """
-
-        for pep in peptides:
-            if 'y' in ion_types:
-                for c in range(charge[0], charge[-1]+1):
-                    mass, desc = Calc.YIonMass(pep, aa_dict, c,
-                                               mods=mods,
-                                               peptide_len=peptide_len,
-                                               peptide_type=peptide_type)
-                    if mass < max_mass:
-                        all_ions.append(mass + xpepmass/c)
-                        desc[0] += xpepdesc
-                        all_desc.append(desc)
-
-    #%% Continue IonsFromXlinkSequence
-
-    # table contains amino acid masses - H2O for better calculation
-    aaPath = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                          './config/aa_masses.txt')
-    with open(aaPath, mode='r') as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        if mass_type == 'monoisotopic':
-            aa_dict = {rows[0]:float(rows[1]) for rows in reader}
-        elif mass_type == 'average':
-            aa_dict = {rows[0]:float(rows[2]) for rows in reader}
-        else:
-            print('No or wrong mass_type specified, assuming monoisotopic masses')
-
-    all_ions = []
-    all_desc = []
+    aa_dict, aa_lookup = LoadAAMasses(mass_type)
 
-    # collect sequences from modified and unmodified peptides (n-term of CID)
-    nterm_unmod1, nterm_mod1, nterm_unmod2, nterm_mod2, nterm_positions=\
-        Calc.XPeptides(peptide1, xlink1, peptide2, xlink2, CTerm=False)
-    # C-terminal of CID break
-    cterm_unmod1, cterm_mod1, cterm_unmod2, cterm_mod2, cterm_positions =\
-        Calc.XPeptides(peptide1, xlink1, peptide2, xlink2, CTerm=True)
+    if verbose:
+        # collect sequences from modified and unmodified peptides (n-term of CID)
+        nterm_unmod1, nterm_mod1, nterm_unmod2, nterm_mod2, nterm_positions=\
+            Calc.XPeptides(peptide1, xlink1, peptide2, xlink2, CTerm=False)
+        # C-terminal of CID break
+        cterm_unmod1, cterm_mod1, cterm_unmod2, cterm_mod2, cterm_positions =\
+            Calc.XPeptides(peptide1, xlink1, peptide2, xlink2, CTerm=True)
 
-    print('Unmodified nterm peptides: {}'.format((', '.join(nterm_unmod1 +
-                                                            nterm_unmod2))))
+        print('Unmodified nterm peptides: {}'.format((', '.join(nterm_unmod1 +
+                                                                nterm_unmod2))))
 
-    print('Unmodified cterm peptides: {}'.format((', '.join(cterm_unmod1 +
-                                                            cterm_unmod2))))
+        print('Unmodified cterm peptides: {}'.format((', '.join(cterm_unmod1 +
+                                                                cterm_unmod2))))
 
-    print('Modified nterm peptides: {}'.format((', '.join(nterm_mod1 +
-                                                            nterm_mod2))))
+        print('Modified nterm peptides: {}'.format((', '.join(nterm_mod1 +
+                                                                nterm_mod2))))
 
-    print('Modified cterm peptides: {}'.format((', '.join(cterm_mod1 +
-                                                            cterm_mod2))))
+        print('Modified cterm peptides: {}'.format((', '.join(cterm_mod1 +
+                                                                cterm_mod2))))
 
-    ######################################################
-    # Nterminal non xlinked peptides
-    ######################################################
-
-    nterm_unmod1 = Calc.NTermPeptides(peptide1, end=xlink1)
-    nterm_unmod2 = Calc.NTermPeptides(peptide2, end=xlink2)
-
-    CalcABions(nterm_unmod1, 'alpha', ion_types, charge, aa_dict,
-               '', # xpepdesc
-               0, # xpepmass
-               mods1)
-    CalcABions(nterm_unmod2, 'beta', ion_types, charge, aa_dict,
-               '', # xpepdesc
-               0, # xpepmass
-               mods2)
-
-    ######################################################
-    # Nterminal xlinked peptides
-    ######################################################
-
-    # calculate mass of modification with peptide2 and xlinker
+    # mass of peptide2 and xlinker as modification of peptide1 and vice versa
     pep2_mass = sum([aa_dict[aa] for aa in peptide2]) + 18.01528
-    xpepmass1 = xlinker_mod + pep2_mass
-    print('Mass of modification for peptide 1: {}'.format(xpepmass1))
-    # same with peptide1
     pep1_mass = sum([aa_dict[aa] for aa in peptide1]) + 18.01528
-    xpepmass2 = xlinker_mod + pep1_mass
-    print('Mass of modification for peptide 2: {}'.format(xpepmass2))
-    # define descriptions for peptide2 bound to (truncated) peptide1
-    xpepdesc1 = '-{}-{}-{}'.format(xlink1, peptide2, xlink2)
-    # same for peptide1 bound to (truncated) peptide2
-    xpepdesc2 = '-{}-{}-{}'.format(xlink2, peptide1, xlink1)
-
-    CalcABions(nterm_mod1, 'alpha', ion_types, charge, aa_dict,
-               xpepdesc1, # xpepdesc
-               xpepmass1, # xpepmass
-               mods1)
-
-    CalcABions(nterm_mod2, 'beta', ion_types, charge, aa_dict,
-               xpepdesc2, # xpepdesc
-               xpepmass2, # xpepmass
-               mods2)
-
-    ######################################################
-    # Cterminal non-xlinked peptides
-    ######################################################
-
-    CalcYions(cterm_unmod1, 'alpha', ion_types, charge, aa_dict,
-               '', # xpepdesc
-               0, # xpepmass
-               mods=mods1,
-               peptide_len=len(peptide1))
-
-    CalcYions(cterm_unmod2, 'beta', ion_types, charge, aa_dict,
-               '', # xpepdesc
-               0, # xpepmass
-               mods=mods2,
-               peptide_len=len(peptide2))
-
-    ######################################################
-    # Cterminal xlinked peptides
-    ######################################################
+    if verbose:
+        print('Mass of modification for peptide 1: {}'.format(xlinker_mod + pep2_mass))
+        print('Mass of modification for peptide 2: {}'.format(xlinker_mod + pep1_mass))
 
-    CalcYions(cterm_mod1, 'alpha', ion_types, charge, aa_dict,
-               xpepdesc1, # xpepdesc
-               xpepmass1, # xpepmass
-               mods=mods1,
-               peptide_len=len(peptide1))
+    # all fragments of both peptides, with and without the partner peptide
+    mz, table = Calc.XlinkFragmentLadder(peptide1, xlink1, peptide2, xlink2,
+                                         xlinker_mod, aa_lookup, charge,
+                                         ion_types, mods1, mods2, max_mass)
 
-    CalcYions(cterm_mod2, 'beta', ion_types, charge, aa_dict,
-               xpepdesc2, # xpepdesc
-               xpepmass2, # xpepmass
-               mods=mods2,
-               peptide_len=len(peptide2))
+    all_ions = mz.tolist()
+    all_desc = Calc.XlinkLadderDescriptions(peptide1, xlink1, peptide2, xlink2,
+                                            table, mods1, mods2)
 
     ######################################################
     # Parent ions
@@ -307,7 +183,8 @@ def IonsFromXlinkSequence(peptide1, xlink1, peptide2, xlink2, xlinker_mod, ion_t
     for c in range(charge[0], charge[1]+1):
         mass, desc = Calc.XParentionMass(pep1_mass, pep2_mass,
                                           peptide1, xlink1,\
-                                          peptide2, xlink2, c, mods1, mods2)
+                                          peptide2, xlink2, c, mods1, mods2,
+                                          xlinker_mod=xlinker_mod)
         if mass < max_mass:
             all_ions.append(mass)
             all_desc.append(desc)
@@ -319,7 +196,72 @@ def IonsFromXlinkSequence(peptide1, xlink1, peptide2, xlink2, xlinker_mod, ion_t
 
 #%%
 
-def AssignAndPlotPSM(spectrum, ions2desc, ppm, ax=None, max_mz=None):
+def ColorFromDesc(desc_list):
+    """
+    Return the plink color scheme for a given ion description
+    """
+    if desc_list[1] == 'A':
+        return 'yellow'
+    elif desc_list[1] == 'a':
+        return 'brown'
+    elif desc_list[1] == 'B':
+        return 'green'
+    elif desc_list[1] == 'b':
+        return 'orange'
+    elif desc_list[1] == 'Y':
+        return 'red'
+    elif desc_list[1] == 'y':
+        return 'purple'
+    elif 'M' in  desc_list[1]:
+        return 'cyan'
+
+
+def AssignPSM(spectrum, ions2desc, ppm):
+    """
+    Assign a given spectrum with a given sequence of theoretical
+    mz and descriptions without plotting anything.
+
+    Args:
+        spectrum: list of lists of experimental mz and intensity
+        ion2desc: dict mapping theoretical mz to description
+        ppm: error allowed during assign in parts-per-million
+
+    Returns:
+        Assignments: Dict with descriptions of assignments as keys and lists
+                     of the corresponding values in order as values
+                     (empty lists if nothing could be assigned)
+        matches: structured array of the matches as returned by
+                 SpectrumMatching.MatchPeaks
+    """
+
+    ion_list = sorted(ions2desc.keys())
+
+    matches = Match.MatchPeaks(spectrum[0], spectrum[1], ion_list, ppm)
+
+    Descriptions = [ions2desc[ion_list[i]] for i in matches['ion']]
+    if Descriptions != []:
+        [Sequences, Types, Positions, Charges, PepTypes, Modifications] =\
+            list(zip(*Descriptions))
+    else:
+        Sequences, Types, Positions, Charges, PepTypes, Modifications =\
+            (), (), (), (), (), ()
+
+    Assignments = {'AssignmentError': list(matches['error_ppm']),
+                   'AssignmentMz': list(matches['theor_mz']),
+                   'Intensity': list(matches['intensity']),
+                   'Color': [ColorFromDesc(desc) for desc in Descriptions],
+                   'Sequences': Sequences,
+                   'Types': Types,
+                   'Positions': Positions,
+                   'Charges': Charges,
+                   'PepTypes': PepTypes,
+                   'Modifications': Modifications}
+
+    return Assignments, matches
+
+
+def AssignAndPlotPSM(spectrum, ions2desc, ppm, ax=None, max_mz=None,
+                     min_rel_intensity=0.0, max_labels=200):
     """
     Annotate a given spectrum with a given sequence of theoretical
     mz and descriptions.
@@ -329,77 +271,35 @@ def AssignAndPlotPSM(spectrum, ions2desc, ppm, ax=None, max_mz=None):
         ion2desc: dict mapping theoretical mz to description
         ppm: error allowed during assign in parts-per-million
         axis (optional): axis to plot the figure on, default currrent axis
+        min_rel_intensity (optional): only label assignments at or above
+                                      this fraction of the base peak
+        max_labels (optional): maximum number of assignments to label
 
     Returns:
         Assignments: Dict with descriptions of assignments as keys and lists
                      of the corresponding values in order as values
     """
+    import matplotlib.pyplot as plt
+    from . import SpectrumPlotting
 
     mz_list = spectrum[0]
-    intensity_list = spectrum[1]
-    ion_list = sorted(ions2desc.keys())
 
     if ax is None:
         ax = plt.gca()
 
-    last = 0
-
-    def ColorFromDesc(desc_list):
-        """
-        Return the plink color scheme for a given ion description
-        """
-        if desc_list[1] == 'A':
-            return 'yellow'
-        elif desc_list[1] == 'a':
-            return 'brown'
-        elif desc_list[1] == 'B':
-            return 'green'
-        elif desc_list[1] == 'b':
-            return 'orange'
-        elif desc_list[1] == 'Y':
-            return 'red'
-        elif desc_list[1] == 'y':
-            return 'purple'
-        elif 'M' in  desc_list[1]:
-            return 'cyan'
-
-    AssignmentError = []
-    AssignmentMz = []
-    Color = []
-    Descriptions = []
-    
-    for idx, mz in enumerate(mz_list):
-        # store axis-object in variable for return
-        ax.plot([mz, mz], # x1, x2
-                [0, intensity_list[idx]], # y1, y2
-                'k-', # style
-                lw=0.5 # line width
-                )
-        for idx, theor_mz in enumerate(ion_list[last:]):
-            if theor_mz >= mz * (1+ppm[0]/10**6):
-                if theor_mz <= mz * (1+ppm[1]/10**6):
-                    # add the relative error of the assignments to the list
-                    AssignmentError.append((mz-theor_mz)/mz * 10**6)
-                    AssignmentMz.append(theor_mz)
-                    Descriptions.append(ions2desc[theor_mz])
-                    Color.append(ColorFromDesc(ions2desc[theor_mz]))
-
-                    ax.plot([theor_mz, theor_mz],
-                               [0, intensity_list[idx]],
-                               ColorFromDesc(ions2desc[theor_mz]),
-                               lw=1,
-                               alpha=0.5)
-                                        
-                    ax.text(theor_mz,
-                              intensity_list[idx]+1000,
-                              '${0}_{{{1}}}^{{{2}+}} {3}$'.format(ions2desc[theor_mz][1],
-                                                              ions2desc[theor_mz][2],
-                                                              ions2desc[theor_mz][3],
-                                                              ions2desc[theor_mz][5]),
-                              {'ha': 'left', 'va': 'bottom'},
-                              rotation=90,
-                              color=ColorFromDesc(ions2desc[theor_mz]))
-                    last += idx
+    Assignments, matches = AssignPSM(spectrum, ions2desc, ppm)
+
+    labels = ['${0}_{{{1}}}^{{{2}+}} {3}$'.format(*desc)
+              for desc in zip(Assignments['Types'],
+                              Assignments['Positions'],
+                              Assignments['Charges'],
+                              Assignments['Modifications'])]
+
+    SpectrumPlotting.PlotAssignments(mz_list, spectrum[1], matches, labels,
+                                     Assignments['Color'], ax=ax,
+                                     min_rel_intensity=min_rel_intensity,
+                                     max_labels=max_labels)
+
     if max_mz == None:
         ax.set_xlim(min(mz_list),max(mz_list))
     else:
@@ -411,20 +311,7 @@ def AssignAndPlotPSM(spectrum, ions2desc, ppm, ax=None, max_mz=None):
     ax.set_xlabel('m/z')
     ax.set_ylabel('Intensity')
 
-    if Descriptions != []:
-        [Sequences, Types, Positions, Charges, PepTypes, Modifications] =\
-            list(zip(*Descriptions))
-
-        Assignments = {'AssignmentError': AssignmentError,
-                       'AssignmentMz': AssignmentMz,
-                       'Color': Color,
-                       'Sequences': Sequences,
-                       'Types': Types,
-                       'Positions': Positions,
-                       'Charges': Charges,
-                       'PepTypes': PepTypes,
-                       'Modifications': Modifications}
-        
+    if Assignments['AssignmentMz'] != []:
         return Assignments
     else:
         raise Exception('Could not assign any peak with the given specifications')
@@ -440,6 +327,9 @@ def PlotHist(data, limits, ax=None):
         limits: range of the plot as list [lower, upper]
         ax: axis to plot the data on
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.mlab as mlab
+
     if ax is None:
         ax = plt.gca()
     n, bins, patches = ax.hist(assignment_error,
@@ -463,6 +353,9 @@ def PlotHist(data, limits, ax=None):
 
 if __name__ == '__main__':
 
+    import matplotlib.pyplot as plt
+    from . import XlinkPic
+
     fig, ([ax1, ax2], [ax3, ax4]) = plt.subplots(nrows=2,
                                                  ncols=2,
                                                  sharex='col',
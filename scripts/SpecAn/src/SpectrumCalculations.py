@@ -5,6 +5,9 @@ Created on Wed Nov 22 09:26:33 2017
 
 @author: User
 """
+import functools
+
+import numpy as np
 
 ############################################
 # Calculation of fragment peptide sequences
@@ -201,7 +204,7 @@ def YIonMass(peptide, aa_dict, charge, mods=[], peptide_len=None, peptide_type='
               charge, peptide_type, Modifications
                      
     Raises:
-        Exception: If not and peptide_len are specified together
+        Exception: If mods are specified without peptide_len
         Exception: If peptide_type is specified other than 'alpha' or 'beta'
         
     """
@@ -212,9 +215,8 @@ def YIonMass(peptide, aa_dict, charge, mods=[], peptide_len=None, peptide_type='
     ion_string = 'Y' if peptide_type == 'alpha' else 'y'
 
     # check modifications
-    if (peptide_len == None and mods != []) or\
-       (peptide_len != None and mods == []):
-           raise Exception('If specifying mods you have to specify peptide length')
+    if peptide_len == None and len(mods) > 0:
+        raise Exception('If specifying mods you have to specify peptide length')
 
     # set initial values
     MassToCharge = 0
@@ -238,6 +240,321 @@ def YIonMass(peptide, aa_dict, charge, mods=[], peptide_len=None, peptide_type='
 
     return MassToCharge, Desc
 
+############################################
+# Vectorized fragment ladders
+############################################
+
+# description table of the ions returned by FragmentLadder
+FragmentDtype = np.dtype([('ion', 'U1'),         # A/B/Y alpha, a/b/y beta
+                          ('start', np.int64),   # first residue (0-based)
+                          ('length', np.int64),  # number of residues
+                          ('charge', np.int64)])
+
+# mass added to the residue sum of a fragment before dividing by charge,
+# same terms as in AIonMass, BIonMass and YIonMass
+_ION_OFFSETS = {'a': lambda c: -28.0101 + c * 1.00794,
+                'b': lambda c: 18.01528 - 17.00734 + (c-1) * 1.00794,
+                'y': lambda c: 18.01528 + c * 1.00794}
+
+
+def ResidueMasses(peptide, aa_dict, mods=[]):
+    """
+    Return the residue masses of a peptide as array with the masses of
+    variable modifications added at their (1-based) positions
+
+    Args:
+        peptide: sequence of the peptide
+        aa_dict: dict mapping amino acid residue names to masses or array of
+                 256 masses indexed by ASCII code (see LoadAAMasses)
+        mods (optional): variable modifications of type [[mass1, pos1], [mass2, pos2]]
+
+    Raises:
+        KeyError: If the peptide contains an unknown residue
+    """
+    if isinstance(aa_dict, np.ndarray):
+        codes = np.frombuffer(peptide.encode('ascii'), dtype=np.uint8)
+        masses = aa_dict[codes]
+        if np.isnan(masses).any():
+            raise KeyError(peptide[int(np.argmax(np.isnan(masses)))])
+    else:
+        masses = np.array([aa_dict[aa] for aa in peptide], dtype=np.float64)
+    for mod in mods:
+        if 1 <= mod[1] <= len(peptide):
+            masses[mod[1] - 1] += mod[0]
+    return masses
+
+
+def FragmentLadder(peptide, aa_dict, charge, ion_types, mods=[],
+                   peptide_type='alpha'):
+    """
+    Calculate the m/z of all a/b/y fragments of a peptide at once
+
+    The residue masses are summed up once by a cumulative sum, every
+    fragment mass is then a single lookup. Ions are returned in the order of
+    IonsFromSequence: n-terminal fragments by length with a before b, then
+    c-terminal fragments from the longest to the shortest, charges ascending.
+
+    Args:
+        peptide: sequence of the peptide to generate fragments from
+        aa_dict: dict or lookup array of residue masses, see ResidueMasses
+        charge: list of [min_charge, max_charge]
+        ion_types: list of which ions to return (a/b/y)
+        mods (optional): variable modifications of type [[mass1_pep1, pos1_pep1], [mass2_pep1, pos2_pep1]]
+        peptide_type (optional): either 'alpha' or 'beta'
+
+    Returns:
+        mz: array of the fragment m/z
+        table: structured array of type FragmentDtype describing every ion
+
+    Raises:
+        Exception: If peptide_type is specified other than 'alpha' or 'beta'
+    """
+    if not peptide_type in ['alpha', 'beta']:
+        raise Exception('You have to specify peptide_type as "alpha" or "beta"!')
+
+    masses = ResidueMasses(peptide, aa_dict, mods)
+    prefix = np.cumsum(masses)
+    length = masses.size
+    charges = np.arange(charge[0], charge[-1]+1)
+
+    # n-terminal fragments of 1 to length-1 residues
+    nterm_len = np.arange(1, length)
+    # c-terminal fragments starting behind residue 1 to length-1
+    cterm_start = np.arange(1, length)
+    cterm_sums = prefix[-1] - prefix[cterm_start - 1] if length else prefix
+
+    all_mz = []
+    all_table = []
+
+    def add(sums, starts, lengths, types):
+        if not types or sums.size == 0:
+            return
+        offsets = np.array([[_ION_OFFSETS[t](c) for c in charges]
+                            for t in types])
+        # shape (fragment, type, charge) gives the order of IonsFromSequence
+        mz = (sums[:, None, None] + offsets[None, :, :]) / charges
+        table = np.empty(mz.shape, dtype=FragmentDtype)
+        names = [t.upper() if peptide_type == 'alpha' else t for t in types]
+        table['ion'] = np.array(names)[None, :, None]
+        table['start'] = starts[:, None, None]
+        table['length'] = lengths[:, None, None]
+        table['charge'] = charges[None, None, :]
+        all_mz.append(mz.ravel())
+        all_table.append(table.ravel())
+
+    add(prefix[:length-1], np.zeros_like(nterm_len), nterm_len,
+        [t for t in ['a', 'b'] if t in ion_types])
+    add(cterm_sums, cterm_start, length - cterm_start,
+        [t for t in ['y'] if t in ion_types])
+
+    if not all_mz:
+        return np.zeros(0), np.zeros(0, dtype=FragmentDtype)
+
+    return np.concatenate(all_mz), np.concatenate(all_table)
+
+
+def LadderDescriptions(peptide, table, mods=[], peptide_type='alpha'):
+    """
+    Expand the table of FragmentLadder into the description lists used by
+    BIonMass and co. like [sequence, type, position, charge, peptide_type,
+    Modifications]
+    """
+    descriptions = []
+    moddescs = {}
+    for ion, start, length, charge in table.tolist():
+        cterm = ion in 'Yy'
+        key = (start, length, cterm)
+        if key not in moddescs:
+            positions = range(start + 1, start + length + 1)
+            if cterm:
+                # y-ions list their mods from the c-terminus like YIonMass
+                positions = reversed(positions)
+            moddescs[key] = ''.join(str(mod[0]) + '({}) '.format(mod[1])
+                                    for pos in positions
+                                    for mod in mods if mod[1] == pos)
+        descriptions.append([peptide[start:start+length], ion, length,
+                             charge, peptide_type, moddescs[key]])
+    return descriptions
+
+
+# description table of the ions returned by XlinkFragmentLadder
+XlinkFragmentDtype = np.dtype(FragmentDtype.descr +
+                              [('beta', np.bool_),      # fragment of peptide2
+                               ('xlinked', np.bool_)])  # carries the partner
+
+
+@functools.lru_cache(maxsize=4096)
+def _XlinkTemplate(len1, xlink1, len2, xlink2, ion_types, charges):
+    """
+    Return the fragments of a cross-linked pair of peptides of the given
+    lengths as arrays, the same for all pairs of these lengths
+
+    Fragment residue sums are prefix[hi] - prefix[lo] with the prefix sums
+    over the residue masses of peptide1 and of peptide2 (each starting with
+    0) stored one after the other.
+
+    Returns:
+        lo, hi: bounds of the fragments in the prefix sum
+        offset, charge: ion type mass offset and charge of every ion
+        adduct1, adduct2: 1.0 for ions carrying peptide2 resp. peptide1
+        table: structured array of type XlinkFragmentDtype
+    """
+    charges = np.arange(charges[0], charges[1]+1)
+    parts = []
+    for beta, (length, xlink, base) in enumerate([(len1, xlink1, 0),
+                                                  (len2, xlink2, len1 + 1)]):
+        fragments = np.arange(1, length)
+        for cterm, types in [(False, [t for t in ['a', 'b'] if t in ion_types]),
+                             (True, [t for t in ['y'] if t in ion_types])]:
+            if not types or fragments.size == 0:
+                continue
+            # shape (fragment, type, charge) gives the order of FragmentLadder
+            shape = (fragments.size, len(types), charges.size)
+            part = np.empty(shape, dtype=XlinkFragmentDtype)
+            names = [t if beta else t.upper() for t in types]
+            part['ion'] = np.array(names)[None, :, None]
+            if cterm:
+                part['start'] = fragments[:, None, None]
+                part['length'] = (length - fragments)[:, None, None]
+                part['xlinked'] = (fragments < xlink)[:, None, None]
+            else:
+                part['start'] = 0
+                part['length'] = fragments[:, None, None]
+                part['xlinked'] = (fragments >= xlink)[:, None, None]
+            part['charge'] = charges[None, None, :]
+            part['beta'] = beta
+            offset = np.array([[_ION_OFFSETS[t](c) for c in charges]
+                               for t in types])
+            parts.append((part.ravel(),
+                          np.broadcast_to(offset[None, :, :], shape).ravel(),
+                          base, cterm))
+
+    if not parts:
+        table = np.zeros(0, dtype=XlinkFragmentDtype)
+        offset = np.zeros(0)
+    else:
+        table = np.concatenate([p[0] for p in parts])
+        offset = np.concatenate([p[1] for p in parts])
+    base = np.concatenate([np.full(p[0].size, p[2]) for p in parts])\
+        if parts else np.zeros(0, dtype=np.int64)
+    cterm = np.concatenate([np.full(p[0].size, p[3]) for p in parts])\
+        if parts else np.zeros(0, dtype=bool)
+
+    # n- before c-terminal, without before with partner, alpha before beta
+    group = 4 * cterm + 2 * table['xlinked'] + table['beta']
+    order = np.argsort(group, kind='stable')
+    table, offset, base = table[order], offset[order], base[order]
+
+    lo = base + table['start']
+    hi = lo + table['length']
+    charge = table['charge'].astype(np.float64)
+    adduct1 = (table['xlinked'] & ~table['beta']).astype(np.float64)
+    adduct2 = (table['xlinked'] & table['beta']).astype(np.float64)
+
+    result = (lo, hi, offset, charge, adduct1, adduct2, table)
+    for array in result:
+        array.setflags(write=False)
+    return result
+
+
+def XlinkFragmentLadder(peptide1, xlink1, peptide2, xlink2, xlinker_mod,
+                        aa_dict, charge, ion_types, mods1=[], mods2=[],
+                        max_mass=None):
+    """
+    Calculate the m/z of all a/b/y fragments of a cross-linked peptide pair
+
+    All fragment masses of both peptides are differences of the cumulative
+    sums over the residues of peptide1 and peptide2. Fragments containing the
+    cross-linked residue (n-terminal fragments of at least xlink residues,
+    c-terminal fragments starting before it) carry the unmodified partner
+    peptide plus cross-linker as constant adduct. The layout of the ions
+    only depends on the peptide lengths and is cached, so generating the
+    ions of many candidate pairs costs a handful of array operations each.
+
+    Ions are returned in the order of IonsFromXlinkSequence: n-terminal
+    before c-terminal fragments, fragments without before fragments with the
+    partner, alpha before beta, then as in FragmentLadder.
+
+    Args:
+        peptide1: sequence of the alpha peptide
+        xlink1: relative (1-based) cross-link position in peptide1
+        peptide2: sequence of the beta peptide
+        xlink2: relative (1-based) cross-link position in peptide2
+        xlinker_mod: modification mass of the cross-linker
+        aa_dict: dict or lookup array of residue masses, see ResidueMasses
+        charge: list of [min_charge, max_charge]
+        ion_types: list of which ions to return (a/b/y)
+        mods1 (optional): variable modifications of peptide1 of type [[mass1, pos1], [mass2, pos2]]
+        mods2 (optional): variable modifications of peptide2
+        max_mass (optional): drop ions whose m/z without the partner is not
+                             below max_mass
+
+    Returns:
+        mz: array of the fragment m/z
+        table: structured array of type XlinkFragmentDtype describing every ion
+    """
+    lo, hi, offset, charges, adduct1, adduct2, table = _XlinkTemplate(
+        len(peptide1), xlink1, len(peptide2), xlink2,
+        tuple(t for t in ['a', 'b', 'y'] if t in ion_types),
+        (charge[0], charge[-1]))
+
+    len1 = len(peptide1)
+    prefix = np.zeros(len1 + len(peptide2) + 2)
+    np.cumsum(ResidueMasses(peptide1, aa_dict, mods1), out=prefix[1:len1+1])
+    np.cumsum(ResidueMasses(peptide2, aa_dict, mods2), out=prefix[len1+2:])
+
+    mz = (prefix[hi] - prefix[lo] + offset) / charges
+    if max_mass is not None:
+        keep = mz < max_mass
+        mz, table = mz[keep], table[keep]
+        charges, adduct1, adduct2 = charges[keep], adduct1[keep], adduct2[keep]
+    else:
+        table = table.copy()
+
+    # unmodified partner peptides plus water and cross-linker
+    mods_mass1 = sum(mod[0] for mod in mods1 if 1 <= mod[1] <= len1)
+    mods_mass2 = sum(mod[0] for mod in mods2 if 1 <= mod[1] <= len(peptide2))
+    partner1 = prefix[len1] - mods_mass1 + 18.01528 + xlinker_mod
+    partner2 = prefix[-1] - mods_mass2 + 18.01528 + xlinker_mod
+
+    mz += (adduct1 * partner2 + adduct2 * partner1) / charges
+
+    return mz, table
+
+
+def XlinkLadderDescriptions(peptide1, xlink1, peptide2, xlink2, table,
+                            mods1=[], mods2=[]):
+    """
+    Expand the table of XlinkFragmentLadder into description lists like
+    LadderDescriptions, fragments carrying the partner get its sequence and
+    the cross-link positions appended to their sequence
+    """
+    ladder = table[list(FragmentDtype.names)]
+    beta = table['beta']
+    descriptions = [None] * len(table)
+    for is_beta, peptide, mods, peptide_type, xpepdesc in [
+            (False, peptide1, mods1, 'alpha',
+             '-{}-{}-{}'.format(xlink1, peptide2, xlink2)),
+            (True, peptide2, mods2, 'beta',
+             '-{}-{}-{}'.format(xlink2, peptide1, xlink1))]:
+        rows = np.flatnonzero(beta == is_beta)
+        for row, desc in zip(rows.tolist(),
+                             LadderDescriptions(peptide, ladder[rows], mods,
+                                                peptide_type)):
+            if table['xlinked'][row]:
+                desc[0] += xpepdesc
+            descriptions[row] = desc
+    return descriptions
+
+
+def CrosslinkMass(pep1_mass, pep2_mass, xlinker_mod):
+    """
+    Return the neutral mass of two cross-linked peptides from the neutral
+    masses of the single peptides (incl. water and modifications)
+    """
+    return pep1_mass + pep2_mass + xlinker_mod
+
+
 def ParentionMass(peptide, aa_dict, charge, mods, peptide_type=None):
     ion_string = 'M+{}H'.format(charge)
     mass = 0
@@ -257,15 +574,16 @@ def ParentionMass(peptide, aa_dict, charge, mods, peptide_type=None):
     return mass, desc
 
 def XParentionMass(pep1_mass, pep2_mass, peptide1, xlink1, peptide2,
-                    xlink2, charge, mods1, mods2, peptide_type=None):
+                    xlink2, charge, mods1, mods2, peptide_type=None,
+                    xlinker_mod=0):
     ion_string = 'M+{}H'.format(charge)
-    mass = sum((pep1_mass, pep2_mass))
+    mass = CrosslinkMass(pep1_mass, pep2_mass, xlinker_mod)
     moddesc = ''
     for mod in mods1:
-        mass += mod[1]
+        mass += mod[0]
         moddesc += str(mod[0]) + '({}) '.format(mod[1])
     for mod in mods2:
-        mass += mod[1]
+        mass += mod[0]
         moddesc += str(mod[0]) + '({}) '.format(mod[1])
 
     mass += charge * 1.00794 # M + nH+
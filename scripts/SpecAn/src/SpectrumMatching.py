@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Plot-free assignment of experimental peaks to theoretical ions
+"""
+import numpy as np
+
+# one row per candidate match of an experimental peak to a theoretical ion
+MatchDtype = np.dtype([('peak', np.int64),        # index into the spectrum
+                       ('ion', np.int64),         # index into the theor. m/z
+                       ('mz', np.float64),        # experimental m/z
+                       ('intensity', np.float64), # experimental intensity
+                       ('theor_mz', np.float64),  # theoretical m/z
+                       ('error_ppm', np.float64)])  # (mz - theor_mz)/mz
+
+
+def MatchPeaks(mz, intensity, theor_mz, ppm):
+    """
+    Match experimental peaks to theoretical m/z within a ppm window.
+
+    Every theoretical m/z in [mz*(1+ppm[0]/10**6), mz*(1+ppm[1]/10**6)] is
+    reported for a peak, so one peak can have several candidates. The
+    windows are located by binary search on the sorted theoretical m/z,
+    which takes O((N+M) log M) for N peaks and M ions.
+
+    Args:
+        mz: experimental m/z
+        intensity: experimental intensities in the same order
+        theor_mz: theoretical m/z in any order
+        ppm: [lower, upper] error allowed in parts-per-million
+
+    Returns:
+        matches: structured array of dtype MatchDtype sorted by peak and
+                 theoretical m/z. peak and ion index into the given arrays
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    theor_mz = np.asarray(theor_mz, dtype=np.float64)
+
+    order = np.argsort(theor_mz, kind='stable')
+    theor_sorted = theor_mz[order]
+
+    lower = np.searchsorted(theor_sorted, mz * (1 + ppm[0] / 10**6),
+                            side='left')
+    upper = np.searchsorted(theor_sorted, mz * (1 + ppm[1] / 10**6),
+                            side='right')
+    counts = np.maximum(upper - lower, 0)
+
+    # expand every window [lower, upper) into one row per candidate
+    peak = np.repeat(np.arange(mz.size), counts)
+    first = np.repeat(lower, counts)
+    run_start = np.repeat(np.cumsum(counts) - counts, counts)
+    ion = order[first + np.arange(peak.size) - run_start]
+
+    matches = np.empty(peak.size, dtype=MatchDtype)
+    matches['peak'] = peak
+    matches['ion'] = ion
+    matches['mz'] = mz[peak]
+    matches['intensity'] = intensity[peak]
+    matches['theor_mz'] = theor_mz[ion]
+    matches['error_ppm'] = (matches['mz'] - matches['theor_mz']) /\
+        matches['mz'] * 10**6
+
+    return matches
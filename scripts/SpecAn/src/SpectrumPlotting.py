@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Batched matplotlib rendering of annotated spectra.
+Kept apart from the assignment so that SpectrumAssignment can be used
+without matplotlib.
+"""
+import numpy as np
+
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+
+def _Sticks(mz, intensity):
+    """
+    Return the segments of a stick spectrum for a LineCollection
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    segments = np.zeros((mz.size, 2, 2))
+    segments[:, :, 0] = mz[:, None]
+    segments[:, 1, 1] = intensity
+    return segments
+
+
+def PlotAssignments(mz, intensity, matches, labels, colors, ax=None,
+                    min_rel_intensity=0.0, max_labels=200):
+    """
+    Draw a spectrum and its assigned peaks with a handful of artists.
+
+    All experimental peaks are drawn as one LineCollection and the matches
+    as one LineCollection per color (i.e. ion type). Only the most intense
+    matches are labelled.
+
+    Args:
+        mz: experimental m/z
+        intensity: experimental intensities
+        matches: structured array as returned by SpectrumMatching.MatchPeaks
+        labels: label text for every match
+        colors: color for every match
+        ax (optional): axis to plot on, default current axis
+        min_rel_intensity (optional): only label matches at or above this
+                                      fraction of the base peak
+        max_labels (optional): label at most this many matches (the most
+                               intense ones), None for no limit
+
+    Returns:
+        ax: the axis plotted on
+    """
+    if ax is None:
+        ax = plt.gca()
+
+    ax.add_collection(LineCollection(_Sticks(mz, intensity),
+                                     colors='k',
+                                     linewidths=0.5))
+
+    colors = np.asarray(colors, dtype=object)
+    for color in set(colors):
+        selected = colors == color
+        ax.add_collection(LineCollection(_Sticks(matches['theor_mz'][selected],
+                                                 matches['intensity'][selected]),
+                                         colors=color,
+                                         linewidths=1,
+                                         alpha=0.5))
+
+    # select the labels from the most intense matches downwards
+    if len(intensity) > 0:
+        cutoff = min_rel_intensity * np.max(intensity)
+    else:
+        cutoff = 0
+    order = np.argsort(-matches['intensity'], kind='stable')
+    order = order[matches['intensity'][order] >= cutoff]
+    if max_labels is not None:
+        order = order[:max_labels]
+
+    for idx in order:
+        ax.text(matches['theor_mz'][idx],
+                matches['intensity'][idx]+1000,
+                labels[idx],
+                {'ha': 'left', 'va': 'bottom'},
+                rotation=90,
+                color=colors[idx])
+
+    if len(intensity) > 0:
+        ax.set_ylim(0, 1.1 * np.max(intensity))
+
+    return ax
@@ -6,83 +6,539 @@ Created on Wed Nov 22 11:37:37 2017
 """
 import re
 import os
-import pickle
+import json
+import mmap
+import hashlib
+import threading
 
-def IndexMGF(mgf_file_handler):
+import numpy as np
+
+# one row per spectrum of an mgf-file, sorted by scan number
+IndexDtype = np.dtype([('scan', np.int64),      # scan number from TITLE
+                       ('offset', np.int64),    # byte offset of BEGIN IONS
+                       ('end', np.int64),       # byte offset after END IONS
+                       ('pepmass', np.float64), # precursor m/z, NaN if missing
+                       ('charge', np.int32)])   # precursor charge, 0 if missing
+
+# number of bytes hashed at the start and the end of the mgf-file
+_HASH_BLOCK = 2**20
+
+# smallest byte range indexed by one worker process
+_MIN_CHUNK = 2**26
+
+
+def _Fingerprint(mgf_path, size=None):
+    """
+    Return size, mtime and a hash of the first and last MiB of a file
+
+    If size is given the hash covers only the first size bytes, so the
+    fingerprint of a file can be compared to the one of its earlier state
+    after data was appended to it.
+    """
+    stat = os.stat(mgf_path)
+    if size is None:
+        size = stat.st_size
+    sha = hashlib.sha1()
+    with open(mgf_path, 'rb') as f:
+        sha.update(f.read(min(_HASH_BLOCK, size)))
+        if size > _HASH_BLOCK:
+            f.seek(max(_HASH_BLOCK, size - _HASH_BLOCK))
+            sha.update(f.read(size - f.tell()))
+    return {'size': size,
+            'mtime': stat.st_mtime_ns,
+            'hash': sha.hexdigest()}
+
+
+def _IndexPaths(mgf_path):
+    """
+    Return the paths of the index and of its fingerprint
+    """
+    indexpath = os.path.splitext(mgf_path)[0] + '.idx'
+    return indexpath, indexpath + '.json'
+
+
+def _ReadIndex(mgf_path):
+    """
+    Return the stored index and fingerprint of an mgf-file without checking
+    them against the file, (None, None) if there is no readable index
+    """
+    indexpath, fingerprintpath = _IndexPaths(mgf_path)
+    try:
+        with open(fingerprintpath, 'r') as f:
+            stored = json.load(f)
+        index = np.load(indexpath, mmap_mode='r')
+        if index.dtype != IndexDtype or\
+           not {'size', 'mtime', 'hash'} <= set(stored):
+            return None, None
+        return index, stored
+    except (OSError, ValueError):
+        return None, None
+
+
+def LoadIndex(mgf_path):
+    """
+    Memory map the index of an mgf-file if it matches the current file
+
+    :params: mgf_path: path of the mgf-file
+
+    :returns: index: array of type IndexDtype or None if there is no index
+    or the mgf-file changed (size, mtime or content) since it was written
+    """
+    index, stored = _ReadIndex(mgf_path)
+    if index is None:
+        return None
+    try:
+        current = _Fingerprint(mgf_path)
+    except OSError:
+        return None
+    # a rewrite can keep the size and the hashed start and end of the file,
+    # so a changed mtime always invalidates the index
+    if stored['size'] != current['size'] or\
+       stored['mtime'] != current['mtime'] or\
+       stored['hash'] != current['hash']:
+        return None
+    return index
+
+
+def _ParseTitle(line, std_pattern, tpp_pattern):
+    """
+    Return the scan number of a TITLE= line
+    """
+    # in case of pXtract:
+    # TITLE=2017_08_04_SVs_BS3_16.2419.2419.4.dta
+    # for MSConvert with TPP compatibility:
+    # TITLE=2017_08_18_SK_3.1093.1093.2 File:"2017_08_18_SK_3.raw", NativeID:"controllerType=0 controllerNumber=1 scan=1093"
+    # MSConvert w/o TPP:
+    # TITLE=2017_08_18_SK_3.1093.1093.2
+    if std_pattern.match(line):
+        m = std_pattern.match(line)
+    elif tpp_pattern.match(line):
+        m = tpp_pattern.match(line)
+    else:
+        raise(Exception('Title not found'))
+    return int(m.group(1))
+
+
+def _ParseCharge(value):
     """
-    Read mgf-file and return a dictionary of spectrum#: line pairs.
+    Return the first charge of a CHARGE= value like 2+ or 2+ and 3+
+    """
+    m = re.match(r'\s*(\d+)\s*([+-]?)', value)
+    if m is None:
+        return 0
+    return -int(m.group(1)) if m.group(2) == '-' else int(m.group(1))
+
+
+def _NextRecord(buf, pos, stop):
+    """
+    Return the offset of the first BEGIN IONS line at or after pos, -1 if
+    there is none before stop
+    """
+    while True:
+        pos = buf.find(b'BEGIN IONS', pos, stop)
+        if pos <= 0 or buf[pos - 1:pos] in (b'\n', b'\r'):
+            return pos
+        pos += 1
+
+
+def _HeaderValue(buf, key, start, stop):
+    """
+    Return the value of a KEY= line within a record, None if it is missing
+    """
+    pos = buf.find(b'\n' + key, start, stop)
+    if pos == -1:
+        return None
+    pos += len(key) + 1
+    eol = buf.find(b'\n', pos, stop)
+    return buf[pos:stop if eol == -1 else eol].rstrip(b'\r')
+
+
+def _IndexRange(mgf_path, start, stop):
+    """
+    Index all spectra whose BEGIN IONS line starts in [start, stop)
+
+    Runs in a worker process for large files. A spectrum without END IONS
+    at the end of the file is skipped as it is still being written.
+
+    :returns: records: list of tuples of IndexDtype in file order
+    """
+    std_pattern = re.compile(r'TITLE=[^\.]+\.(\d+)\.\d+\.\d+')
+    tpp_pattern = re.compile(r'TITLE=.*scan=(\d+)')
+
+    records = []
+    with open(mgf_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return records
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = _NextRecord(buf, start, min(stop, size))
+            while pos != -1:
+                end = buf.find(b'\nEND IONS', pos)
+                if end == -1:
+                    break
+                eol = buf.find(b'\n', end + 9)
+                end = size if eol == -1 else eol + 1
+
+                title = _HeaderValue(buf, b'TITLE=', pos, end)
+                if title is None:
+                    raise(Exception('Title not found'))
+                scan = _ParseTitle('TITLE=' + title.decode('utf-8', 'replace'),
+                                   std_pattern, tpp_pattern)
+                pepmass = _HeaderValue(buf, b'PEPMASS=', pos, end)
+                pepmass = float(pepmass.split()[0]) if pepmass else np.nan
+                charge = _HeaderValue(buf, b'CHARGE=', pos, end)
+                charge = _ParseCharge(charge.decode('ascii', 'replace'))\
+                    if charge else 0
+
+                records.append((scan, pos, end, pepmass, charge))
+                pos = _NextRecord(buf, end, min(stop, size))
+        finally:
+            buf.close()
+
+    return records
+
+
+def _SplitRanges(mgf_path, start, size, processes):
+    """
+    Split [start, size) of an mgf-file into byte ranges that begin at a
+    BEGIN IONS line, one or a few per worker process
+    """
+    chunk = max(_MIN_CHUNK, (size - start) // (4 * processes) + 1)
+    bounds = [start]
+    with open(mgf_path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start + chunk
+            while pos < size:
+                pos = _NextRecord(buf, pos, size)
+                if pos == -1:
+                    break
+                bounds.append(pos)
+                pos += chunk
+        finally:
+            buf.close()
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def IndexMGF(mgf_file_handler, processes=None):
+    """
+    Read mgf-file and return an index of the byte offsets of all spectra.
     Necessary for directly accessing spectra during run
 
+    The index is stored next to the mgf-file and memory mapped on later
+    calls. If data was appended to the mgf-file since (the old content is
+    still at its start), only the new part is indexed, if anything else
+    changed the index is rebuilt. Large files are
+    split at BEGIN IONS lines and indexed in parallel.
+
     :params: mgf_file: file-handler of an opened mgf-file in tpp or std style
+    (or its path)
+    :params: processes: number of worker processes for large files, default
+    all CPUs
 
-    :returns: spactrum2offset: Dict object with the scan numbers as keys and the
-    corresponding offset of the mgf-file as values
+    :returns: spectrum2offset: array of type IndexDtype sorted by scan number
     """
 
+    if isinstance(mgf_file_handler, str):
+        mgf_path = mgf_file_handler
+    else:
+        mgf_path = mgf_file_handler.name
+
     # try restoring the index from a previously saved file
-    indexpath = os.path.splitext(mgf_file_handler.name)[0] + '.idx'
-    try:
-        with open(indexpath, 'rb') as f:
-            print('Reading existing indexfile at {}...'.format(os.path.abspath(indexpath)))
-            return pickle.load(f)
-    # if the indexfile was not present, generate a new index
-    except:
-        std_pattern = re.compile(r'TITLE=[^\.]+\.(\d+)\.\d+\.\d+')
-        tpp_pattern = re.compile(r'TITLE=.*scan=(\d+)')
+    index = LoadIndex(mgf_path)
+    if index is not None:
+        print('Reading existing indexfile at {}...'.format(
+            os.path.abspath(_IndexPaths(mgf_path)[0])))
+        return index
+
+    fingerprint = _Fingerprint(mgf_path)
+    size = fingerprint['size']
 
+    # the file was appended to if the old content is still at its start
+    old, stored = _ReadIndex(mgf_path)
+    start = 0
+    if old is not None and stored['size'] < size and\
+       _Fingerprint(mgf_path, stored['size'])['hash'] == stored['hash']:
+        # resume after the last complete spectrum of the old index
+        start = int(old['end'].max()) if len(old) else 0
+        print('Indexing appended data...')
+    else:
+        old = None
         print('Indexing...')
 
-        spectrum2offset = {}
-        offset = 0
-        for line in mgf_file_handler:
-            if line.startswith('TITLE='):
-                # in case of pXtract:
-                # TITLE=2017_08_04_SVs_BS3_16.2419.2419.4.dta
-                # for MSConvert with TPP compatibility:
-                # TITLE=2017_08_18_SK_3.1093.1093.2 File:"2017_08_18_SK_3.raw", NativeID:"controllerType=0 controllerNumber=1 scan=1093"
-                # MSConvert w/o TPP:
-                # TITLE=2017_08_18_SK_3.1093.1093.2
-                if std_pattern.match(line):
-                    m = std_pattern.match(line)
-                    spectrum = m.group(1)
-                elif tpp_pattern.match(line):
-                    m = tpp_pattern.match(line)
-                    spectrum = m.group(1)
-                else:
-                    raise(Exception('Title not found'))
-                spectrum2offset[int(spectrum)] = offset
-            offset += len(line)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    ranges = _SplitRanges(mgf_path, start, size, processes)
+    if processes > 1 and len(ranges) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parts = list(pool.map(_IndexRange,
+                                  [mgf_path] * len(ranges),
+                                  [r[0] for r in ranges],
+                                  [r[1] for r in ranges]))
+    else:
+        parts = [_IndexRange(mgf_path, a, b) for a, b in ranges]
+
+    index = np.array([r for part in parts for r in part], dtype=IndexDtype)
+    if old is not None:
+        index = np.concatenate([np.asarray(old), index])
+    # sorting by offset within a scan keeps the file order of repeated scans
+    index = index[np.lexsort((index['offset'], index['scan']))]
+
+    indexpath, fingerprintpath = _IndexPaths(mgf_path)
+    # the memory mapped old index must be released before overwriting it
+    del old
+    with open(indexpath + '.tmp', 'wb') as f:
+        np.save(f, index)
+    os.replace(indexpath + '.tmp', indexpath)
+    with open(fingerprintpath, 'w') as f:
+        json.dump(fingerprint, f)
+
+    return index
+
+
+def LookupScan(spectrum2offset, scanno):
+    """
+    Return the index entry of a scan number. If a scan occurs several times
+    in the mgf-file the last one is returned.
+
+    :params: spectrum2offset: index as returned by IndexMGF
+    :params: scanno: scan number to look up
+
+    :raises: KeyError: if the scan is not in the index
+    """
+    pos = np.searchsorted(spectrum2offset['scan'], scanno, side='right') - 1
+    if pos < 0 or spectrum2offset['scan'][pos] != scanno:
+        raise KeyError(scanno)
+    return spectrum2offset[pos]
+
+
+# first peak line of a spectrum record, i.e. the first line starting with a digit
+_peak_start = re.compile(rb'^[0-9]', re.M)
+
+# sign of a fragment charge column like 2+, but not of an exponent like 1e+05
+_charge_sign = re.compile(rb'(\s\d+)[+-](?=\s|$)')
+
+
+def ParsePeaks(record):
+    """
+    Parse the peak block of a single mgf spectrum record at once
+
+    Peaks may be separated by spaces or tabs and may carry a third column
+    with the fragment charge (e.g. 2+), which is ignored.
+
+    :params: record: bytes (or buffer) from BEGIN IONS to END IONS
+
+    :returns: mz, intensity: float64 arrays
+    """
+    if not isinstance(record, (bytes, bytearray)):
+        record = bytes(record)
+    m = _peak_start.search(record)
+    stop = record.rfind(b'END IONS')
+    if m is None or stop < m.start():
+        return np.zeros(0), np.zeros(0)
+    block = bytes(record[m.start():stop])
+
+    # number of columns from the first peak line
+    ncols = len(block[:block.find(b'\n')].split())
+    if b'+' in block or b'-' in block:
+        block = _charge_sign.sub(rb'\1', block)
+
+    # numpys text parser treats every whitespace (incl. tabs) as separator
+    values = np.fromstring(block.decode('ascii'), dtype=np.float64, sep=' ')
+    if ncols < 2 or values.size % ncols:
+        # ragged block, fall back to parsing every line
+        rows = [line.split()[:2] for line in block.splitlines()
+                if len(line.split()) >= 2]
+        values = np.array(rows, dtype=np.float64).reshape(-1)
+        ncols = 2
+    values = values.reshape(-1, ncols)
+
+    return values[:, 0].copy(), values[:, 1].copy()
+
+
+def ReadSpectrumArrays(scanno, mgf_file_handler, spectrum2offset):
+    """
+    Grab a spectrum by scan number from an indexed mgf-file with a single read
+
+    :params: scanno: scan number of the spectrum
+    :params: mgf_file_handler: handler for the input file (binary or text)
+    :params: spectrum2offset: index as returned by IndexMGF
 
-        with open(indexpath, 'wb') as f:
-            pickle.dump(spectrum2offset, f, pickle.HIGHEST_PROTOCOL)
+    :returns: mz, intensity: float64 arrays
+    """
+    entry = LookupScan(spectrum2offset, scanno)
+    # offsets are bytes, so always read from the underlying binary file
+    f = getattr(mgf_file_handler, 'buffer', mgf_file_handler)
+    f.seek(int(entry['offset']), 0)
+    return ParsePeaks(f.read(int(entry['end'] - entry['offset'])))
+
+
+def IterSpectra(mgf_file_handler, spectrum2offset, scans=None):
+    """
+    Iterate over many spectra of an indexed mgf-file
+
+    The spectra are read in file order into one reused buffer.
+
+    :params: mgf_file_handler: handler for the input file (binary or text)
+    :params: spectrum2offset: index as returned by IndexMGF
+    :params: scans: scan numbers to read, default all
+
+    :yields: scan, mz, intensity
+    """
+    if scans is None:
+        entries = np.asarray(spectrum2offset)
+    else:
+        entries = np.array([LookupScan(spectrum2offset, s) for s in scans],
+                           dtype=IndexDtype)
+    entries = entries[np.argsort(entries['offset'], kind='stable')]
+
+    f = getattr(mgf_file_handler, 'buffer', mgf_file_handler)
+    buffer = bytearray(2**16)
+    for entry in entries:
+        size = int(entry['end'] - entry['offset'])
+        if size > len(buffer):
+            buffer = bytearray(2 * size)
+        view = memoryview(buffer)[:size]
+        f.seek(int(entry['offset']), 0)
+        f.readinto(view)
+        mz, intens = ParsePeaks(view)
+        yield int(entry['scan']), mz, intens
+
+
+class MGFFile(object):
+    """
+    Random access to the spectra of an indexed mgf-file through mmap.
+
+    Spectra are served by slicing the memory mapped file with the offsets of
+    the index, there is no shared file position. One object can therefore
+    be used from several threads and be passed to (forked or spawned) worker
+    processes; a process that did not create the mapping maps the file
+    again on first access and reloads the index from disk instead of
+    indexing again.
+
+    Usage:
+        mgf = MGFFile('run.mgf')
+        mz, intensity = mgf[2419]
+    """
+
+    def __init__(self, mgf_path, index=None):
+        """
+        Args:
+            mgf_path: path of the mgf-file
+            index (optional): index as returned by IndexMGF, by default the
+                              index is loaded or built with IndexMGF
+        """
+        self.path = os.path.abspath(mgf_path)
+        self.index = IndexMGF(self.path) if index is None else index
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def __getstate__(self):
+        # mappings and locks cannot be pickled, the index is reloaded
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        index = LoadIndex(self.path)
+        self.index = IndexMGF(self.path) if index is None else index
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def _buffer(self):
+        """
+        Return the mapping of the file, mapping it in the current process
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    f = open(self.path, 'rb')
+                    if os.fstat(f.fileno()).st_size == 0:
+                        # an empty file cannot be mapped
+                        self._map = b''
+                    else:
+                        self._map = mmap.mmap(f.fileno(), 0,
+                                              access=mmap.ACCESS_READ)
+                    self._file = f
+                    self._pid = os.getpid()
+        return self._map
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, scanno):
+        try:
+            LookupScan(self.index, scanno)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, scanno):
+        """
+        Return (mz, intensity) of a scan as float64 arrays
+        """
+        entry = LookupScan(self.index, scanno)
+        return ParsePeaks(self._buffer()[int(entry['offset']):int(entry['end'])])
+
+    def scans(self):
+        """
+        Return the scan numbers of all spectra in the file
+        """
+        return np.asarray(self.index['scan'])
+
+    def precursor(self, scanno):
+        """
+        Return (precursor m/z, charge) of a scan
+        """
+        entry = LookupScan(self.index, scanno)
+        return float(entry['pepmass']), int(entry['charge'])
+
+    def close(self):
+        """
+        Release the mapping of the current process
+        """
+        if self._pid == os.getpid():
+            if isinstance(self._map, mmap.mmap):
+                self._map.close()
+            self._file.close()
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-        return spectrum2offset
 
 def ReadSpectrum(scanno, mgf_file_handler, spectrum2offset):
     """
     Grab a spectrum by scan number from an indexed mgf-file
 
     :params: mgf_file_handler: handler for the input file
-    :params: spectrum2offset: dictionary linking scan # and line #
+    :params: spectrum2offset: index as returned by IndexMGF (or a dict
+    linking scan # and offset)
+
+    :returns: (mz, intensity) as float64 arrays
     """
-    mgf_file_handler.seek(spectrum2offset[scanno], 0)
-    print('Starting at offset {}'.format(spectrum2offset[scanno]))
-    mz_list, intens_list = [], []
-    while True:
-        # loop through the lines of the spectrum until end-signal
-        line = mgf_file_handler.readline()
-        if line[0] in '0123456789':
-            # skip lines not starting with a number
-            try:
-                [mz, intens] = line.strip().split(' ')
-            except Exception as e:
-                print('Spectrum Reading Exception: {}'.format(e))
-                print('Line was {}'.format(line))
-                continue
-            mz_list.append(float(mz))
-            intens_list.append(float(intens))
-        elif line.startswith('END IONS'):
-            # leave loop if the current spectrum ends
-            break
-
-    return (mz_list, intens_list)
+    if isinstance(spectrum2offset, dict):
+        # old style index without end offsets
+        f = getattr(mgf_file_handler, 'buffer', mgf_file_handler)
+        f.seek(spectrum2offset[scanno], 0)
+        record = b''
+        while b'END IONS' not in record:
+            chunk = f.read(2**16)
+            if not chunk:
+                break
+            record += chunk
+        return ParsePeaks(record[:record.find(b'END IONS') + 8])
+
+    return ReadSpectrumArrays(scanno, mgf_file_handler, spectrum2offset)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the mgf peak parsing of SpectrumReader
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+from SpecAn.src import SpectrumReader as Reader
+
+
+def _Record(peaks):
+    return ('BEGIN IONS\nTITLE=run.2419.2419.2\nPEPMASS=500.25\nCHARGE=2+\n' +
+            peaks + 'END IONS\n').encode('ascii')
+
+
+def test_ParsePeaks_plain():
+    mz, intensity = Reader.ParsePeaks(_Record('100.0 1500.5\n200.5\t20\n'))
+    np.testing.assert_array_equal(mz, [100.0, 200.5])
+    np.testing.assert_array_equal(intensity, [1500.5, 20.0])
+
+
+def test_ParsePeaks_scientific_notation():
+    mz, intensity = Reader.ParsePeaks(_Record('100.0 1.5e+05\n'
+                                              '200.5 2.5E-03\n'
+                                              '3.005e+02 7E+1\n'))
+    np.testing.assert_array_equal(mz, [100.0, 200.5, 300.5])
+    np.testing.assert_array_equal(intensity, [1.5e5, 2.5e-3, 70.0])
+
+
+def test_ParsePeaks_charge_column():
+    mz, intensity = Reader.ParsePeaks(_Record('100.0 1.5e+05 2+\n'
+                                              '200.5 2.5E-03 1-\n'
+                                              '300.5 7E+1 3+\n'))
+    np.testing.assert_array_equal(mz, [100.0, 200.5, 300.5])
+    np.testing.assert_array_equal(intensity, [1.5e5, 2.5e-3, 70.0])
+
+
+def test_ParsePeaks_empty():
+    mz, intensity = Reader.ParsePeaks(_Record(''))
+    assert mz.size == 0 and intensity.size == 0
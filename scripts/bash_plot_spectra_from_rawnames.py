@@ -16,6 +16,8 @@ import matplotlib.pyplot as plt
 
 import time
 
+from concurrent.futures import ProcessPoolExecutor
+
 import csv
 
 # to export single figures into pdf
@@ -33,165 +35,184 @@ ColsToPlot = ['Kommentar',
               'Trap Collision Energy',
               'Sample prep']
 
-#################### Argparser ##########################
+################### Extraction ##########################
 
-parser = argparse.ArgumentParser()
+def extract_spectrum(mzml, use_cache=False):
+    """
+    Extract and bin the spectrum of a single mzml file.
+    Runs in a worker process and only returns the binned numpy arrays.
+    """
 
-parser.add_argument("rawfiles", help="path to tsv-file to print spectra from",
-                                type=str)
+    # extract the raw Peaklist from the mzml file
+    PeakList = nMS.ExtractPeakrangeAsList(fname=mzml,
+                                          start=1,
+                                          end='end',
+                                          returntype='array',
+                                          points=100,
+                                          exclude=[(0, 0)],
+                                          cache=use_cache)
 
-parser.add_argument('-m', '--mzmldir', help='Path dor dir storing mzml versions\
-                                             of the files of interest. \n For\
-                                             conversion unse the proteowizard\
-                                             package.')
+    # digitize and smoothe (savitzky golay) peaklist to clear the view
+    return nMS.DigitizePeaklist(PeakList,
+                                resolution=0.5,
+                                debug=False,
+                                sg=True,
+                                inputtype='list',
+                                returntype='tuple')
 
-parser.add_argument('-t', '--title', help='Title for output pdf-file')
 
-# generate parser object -> extract arguments from input
-args = parser.parse_args()
+def main():
 
-# Read arguments from input
-ParameterDataPath = args.rawfiles.strip()
-print('Reading rawfiles from {}'.format(ParameterDataPath))
+    #################### Argparser ##########################
 
-if args.mzmldir == None:
-    mzmlPath = '/home/aretaon/AGW/massspec/_people/jbender/1_data/mzml-files'
-else:
-    mzmlPath = args.mzmldir.strip()
+    parser = argparse.ArgumentParser()
 
-if args.title != None:
-    main_title = args.title
-else:
-    main_title = '{}_extracted_spectra'.format(thisdate)
+    parser.add_argument("rawfiles", help="path to tsv-file to print spectra from",
+                                    type=str)
 
-############## Extract Rawfile Names ####################
+    parser.add_argument('-m', '--mzmldir', help='Path dor dir storing mzml versions\
+                                                 of the files of interest. \n For\
+                                                 conversion unse the proteowizard\
+                                                 package.')
 
-# open the excel file and extract the Rawfiles column
-RawfilesNames = []
-AnnText = []
-with open(ParameterDataPath, 'r') as r:
-    ParameterData = csv.DictReader(r,
-                                   dialect='excel-tab')
-    for row in ParameterData:
-        RawfilesNames.append(row['Rawfile'])
+    parser.add_argument('-t', '--title', help='Title for output pdf-file')
 
-        # extract the annotation information
-        AnnTextTemp = []
-        for Col in ColsToPlot:
-            if Col in row.keys():
-                AnnTextTemp.append('{}: {}'.format(Col, row[Col]))
+    parser.add_argument('-c', '--cache', action='store_true',
+                        help='Keep a binary copy of every mzml file for faster\
+                              re-plotting (see nativeMS.CacheRun)')
 
-        AnnText.append(AnnTextTemp)
-# extract rawfile names from the first column of the excel file
-RawfilesNames = [r.split('.')[0] for r in RawfilesNames]
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes for the extraction,\
+                              defaults to the number of CPUs')
 
-print('Extracted rawfiles: \n{}'.format('\n'.join(RawfilesNames)))
+    # generate parser object -> extract arguments from input
+    args = parser.parse_args()
 
-############# Check if corresponding mzml exist ##########
-# List of mzml files in the mzmlPath to extract spectra from
-mzmlNames = []
-# iterate through rawnames and check for existence of mzml files
-for rawfile in RawfilesNames:
-    found = False
-    # check different version of the mzml extension
-    PossibleRawnames = [rawfile + ext for ext in ['.mzml', '.mzML']]
-    for r in PossibleRawnames:
-        if found is True:
-            continue  # avoid using both extensions
-        FullPath = os.path.join(mzmlPath, r)
-        if os.path.isfile(FullPath):
-            mzmlNames.append(FullPath)
-            found = True
-    if found is not True:
-        print('Didnt find a mzMl file for {} at {}'.format(rawfile, FullPath))
-        mzmlNames.append(None)
+    # Read arguments from input
+    ParameterDataPath = args.rawfiles.strip()
+    print('Reading rawfiles from {}'.format(ParameterDataPath))
 
-############################ Plotting ####################
+    if args.mzmldir == None:
+        mzmlPath = '/home/aretaon/AGW/massspec/_people/jbender/1_data/mzml-files'
+    else:
+        mzmlPath = args.mzmldir.strip()
 
-# List of figure objects for plotting
-PlotList = []
+    if args.title != None:
+        main_title = args.title
+    else:
+        main_title = '{}_extracted_spectra'.format(thisdate)
+
+    ############## Extract Rawfile Names ####################
+
+    # open the excel file and extract the Rawfiles column
+    RawfilesNames = []
+    AnnText = []
+    with open(ParameterDataPath, 'r') as r:
+        ParameterData = csv.DictReader(r,
+                                       dialect='excel-tab')
+        for row in ParameterData:
+            RawfilesNames.append(row['Rawfile'])
+
+            # extract the annotation information
+            AnnTextTemp = []
+            for Col in ColsToPlot:
+                if Col in row.keys():
+                    AnnTextTemp.append('{}: {}'.format(Col, row[Col]))
+
+            AnnText.append(AnnTextTemp)
+    # extract rawfile names from the first column of the excel file
+    RawfilesNames = [r.split('.')[0] for r in RawfilesNames]
+
+    print('Extracted rawfiles: \n{}'.format('\n'.join(RawfilesNames)))
+
+    ############# Check if corresponding mzml exist ##########
+    # List of mzml files in the mzmlPath to extract spectra from
+    mzmlNames = []
+    # iterate through rawnames and check for existence of mzml files
+    for rawfile in RawfilesNames:
+        found = False
+        # check different version of the mzml extension
+        PossibleRawnames = [rawfile + ext for ext in ['.mzml', '.mzML']]
+        for r in PossibleRawnames:
+            if found is True:
+                continue  # avoid using both extensions
+            FullPath = os.path.join(mzmlPath, r)
+            if os.path.isfile(FullPath):
+                mzmlNames.append(FullPath)
+                found = True
+        if found is not True:
+            print('Didnt find a mzMl file for {} at {}'.format(rawfile, FullPath))
+            mzmlNames.append(None)
+
+    ############################ Plotting ####################
+
+    # extract and bin all spectra in parallel, only the pdf is assembled here
+    ToExtract = [m for m in mzmlNames if m is not None]
+    for m in ToExtract:
+        print('Parsing {}'.format(os.path.basename(m)))
 
-# fancier plots
-plt.style.use('ggplot')
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        # map returns the results in the order of the tsv
+        Spectra = dict(zip(ToExtract,
+                           pool.map(extract_spectrum, ToExtract,
+                                    [args.cache] * len(ToExtract))))
 
-# save the pdf in the current working dir using main_title as title
-pp = PdfPages(os.path.join(os.getcwd(), mt.alphanum_string(main_title)) + '.pdf')
+    # fancier plots
+    plt.style.use('ggplot')
 
-for idx, m in enumerate(mzmlNames):
+    # save the pdf in the current working dir using main_title as title
+    pp = PdfPages(os.path.join(os.getcwd(), mt.alphanum_string(main_title)) + '.pdf')
 
-    # print only spectra for rawfiles w/ mzml file
-    if m is not None:
+    for idx, m in enumerate(mzmlNames):
 
-        print('Parsing {}'.format(os.path.basename(m)))
+        # print only spectra for rawfiles w/ mzml file
+        if m is not None:
 
-        # extract the raw Peaklist from the mzml file
-        PeakList = nMS.ExtractPeakrangeAsList(fname=m,
-                                              start=1,
-                                              end='end',
-                                              returntype='tuple',
-                                              points=100,
-                                              exclude=[(0, 0)])
-
-        # digitize and smoothe (savitzky golay) peaklist to clear the view
-        PeakList = nMS.DigitizePeaklist(PeakList,
-                                        resolution=0.5,
-                                        debug=False,
-                                        sg=True,
-                                        inputtype='tuple',
-                                        returntype='tuple')
-
-        # fetch a figure object for the spectrum plot
-        fig = nMS.PlotPeaklist(PeakList,
-                               start='start',
-                               end='end',
-                               inputtype='tuple',
-                               plot='return')
-
-        # get current axis from figure
-        ax = fig.gca()
-
-        # give the figure a title
-        ax.set_title(os.path.basename(m))
+            # fetch a figure object for the spectrum plot
+            fig = nMS.PlotPeaklist(Spectra[m],
+                                   start='start',
+                                   end='end',
+                                   inputtype='tuple',
+                                   plot='return')
 
-        # add annotation to the plots in the top right corner of the plot
-        plt.text(1, 1, '\n'.join(AnnText[idx]),
-                 va='top',
-                 ha='right',
-                 fontsize=6,
-                 transform=ax.transAxes,
-                 bbox=dict(facecolor='red',
-                           alpha=0.5))
+            # get current axis from figure
+            ax = fig.gca()
 
-        # save plots to pdf
-        pp.savefig(fig)
+            # give the figure a title
+            ax.set_title(os.path.basename(m))
 
-    # catch rawfile w/o any mzml file == if m is None
-    else:
-        
-        # Set empty variable to print no spectrum
-        plt.clf() # clear figure
-        
-        # give the figure a title
-        ax.set_title(os.path.basename(RawfilesNames[idx]))
-
-        # write error message instead of plot to pdf file
-        plt.text(0.5, 0.5, 'mzML file not found',
-                 va='top',
-                 ha='right',
-                 fontsize=12,
-                 transform=ax.transAxes)
+        # catch rawfile w/o any mzml file == if m is None
+        else:
+
+            # Set empty figure to print no spectrum
+            fig, ax = plt.subplots()
+
+            # give the figure a title
+            ax.set_title(os.path.basename(RawfilesNames[idx]))
+
+            # write error message instead of plot to pdf file
+            ax.text(0.5, 0.5, 'mzML file not found',
+                    va='top',
+                    ha='right',
+                    fontsize=12,
+                    transform=ax.transAxes)
 
         # add annotation to the plots in the top right corner of the plot
-        plt.text(1, 1, '\n'.join(AnnText[idx]),
-                 va='top',
-                 ha='right',
-                 fontsize=6,
-                 transform=ax.transAxes,
-                 bbox=dict(facecolor='red',
-                           alpha=0.5))
-        
+        ax.text(1, 1, '\n'.join(AnnText[idx]),
+                va='top',
+                ha='right',
+                fontsize=6,
+                transform=ax.transAxes,
+                bbox=dict(facecolor='red',
+                          alpha=0.5))
+
         # save plots to pdf
         pp.savefig(fig)
+        plt.close(fig)
+
+    # close handler for pdf
+    pp.close()
+
 
-# close handler for pdf
-pp.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,16 @@
 import os
 os.chdir(r'C:\Sabine\fasta_sabine\SVs_Fasta_perseus\20190329_extractFASTAMQ')
 
-import fastaFunctions
+import sys
 import pandas as pd
 
-import re
+sys.path.append(r'C:\Users\User\Documents\03_software\python')
+import PyMS.modules.Sequences as Seq
 
-accessions, sequences = fastaFunctions.read_fasta_file_fullID('uniprot_proteome_rattus_norvergicus.fasta')
+fasta = 'uniprot_proteome_rattus_norvergicus.fasta'
 
-UniProtIDs = []
-
-uniprotPattern = re.compile(r'.+\|(\S+)\|.+')
-
-for acc in accessions:
-    if uniprotPattern.match(acc):
-        match = uniprotPattern.match(acc)
-        thisID = match.group(1)
-        UniProtIDs.append(thisID)
-    
+# accession -> position of the entry in the fasta, stored next to the fasta
+index = Seq.LoadFastaIndex(fasta)
 
 ID_srt = pd.read_excel(r'C:\Sabine\fasta_sabine\SVs_Fasta_perseus\ID_for_fasta_20190408.xlsx', sheetname='ID_for_fasta_sortiert').iloc[0:400,:]
 
@@ -43,16 +36,15 @@ for ID in intenseIDs:
 with open('ID_srt_filtered.fasta', 'w') as out:
     for protein in mostIntenseProteins:
         print('Looking for {}'.format(protein))
-        found = False
-        for idx, thisID in enumerate(UniProtIDs):
-                if protein == thisID:
-                    print('Found {}'.format(thisID))
-                    out.write('>' + accessions[idx] + '\n')
-                    out.write(sequences[idx] + '\n')
-                    print('Wrote {}'.format(accessions[idx]))
-                    found = True
-        if found == False:
+        try:
+            header, sequence = Seq.FetchFasta(fasta, protein, index)
+        except KeyError:
             print('Couldnt find {} in DB'.format(protein))
+            continue
+        print('Found {}'.format(protein))
+        out.write('>' + header + '\n')
+        out.write(sequence + '\n')
+        print('Wrote {}'.format(header))
 
 
 # write fasta for first entrys in majority protein IDs
@@ -67,11 +59,10 @@ for ID in intenseIDs:
 
 with open('ID_all_filtered.fasta', 'w') as out:
     for protein in mostIntenseProteins:
-        found = False
-        for idx, thisID in enumerate(UniProtIDs):
-                if protein == thisID:
-                    out.write('>' + accessions[idx] + '\n')
-                    out.write(sequences[idx] + '\n')
-                    found = True
-        if found == False:
-            print('Couldnt find {} in DB'.format(protein))
\ No newline at end of file
+        try:
+            header, sequence = Seq.FetchFasta(fasta, protein, index)
+        except KeyError:
+            print('Couldnt find {} in DB'.format(protein))
+            continue
+        out.write('>' + header + '\n')
+        out.write(sequence + '\n')
\ No newline at end of file
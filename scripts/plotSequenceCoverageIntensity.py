@@ -7,6 +7,7 @@ import argparse
 
 sys.path.append(r'C:\Users\User\Documents\03_software\python')
 import PyMS.modules.Sequences as Seq
+import PyMS.modules.MaxQuant as MQ
 
 parser = argparse.ArgumentParser()
 parser.add_argument('txt_path', help="Path to the MaxQuant txt folder")
@@ -22,13 +23,18 @@ targetProtein = args.target_name
 
 fastafile = args.fasta_path
 
-data = pd.read_csv(infile, delimiter='\t')
-data = data[data['Proteins'].str.contains(targetProtein)]
-data = data[data['Intensity'].notnull()]
+# filter the evidence chunk by chunk and only keep the columns needed
+columns = MQ.MaxQuantColumns(columns=('Proteins', 'Sequence', 'Intensity',
+                                      'Experiment'))
+chunks = []
+for chunk in MQ.ReadMaxQuantTable(infile, usecols=columns, chunksize=10**6):
+    chunk = chunk[chunk['Proteins'].astype(str).str.contains(targetProtein,
+                                                             regex=False)]
+    chunks.append(chunk[chunk['Intensity'].notnull()])
+data = pd.concat(chunks)
 
-IDList, sequenceList = Seq.ReadFasta(fastafile)
-
-thisSequence = sequenceList[IDList.index(targetProtein)]
+# only the target protein is read from the fasta via its index
+header, thisSequence = Seq.FetchFasta(fastafile, targetProtein)
 
 def generate_plot(df, thisSequence, label=None):
     